@@ -1,25 +1,76 @@
 import sys
-from .weaver import install, uninstall
+import json
+import math
+import time
+import random
+import weakref
+import threading
+import contextlib
+import importlib
+import collections
+from .weaver import install, uninstall, batch, find_caller
+from .registry import get_key, find_owner
+from . import weaver
+from . import codeindex
+from . import tracing
+from .context import ContextVar, per_task
+
+if sys.version_info >= (3, 6):
+   from . import coroutines
+else:
+   coroutines = None
+
+# The async wrappers of bases that keep state in a ContextVar only work if
+# the state follows tasks, which needs contextvars (Python 3.7 and up). On
+# 3.6, concurrent tasks on one thread would share it, so those bases advise
+# the creation of a coroutine there instead, as on older versions.
+task_coroutines = coroutines if per_task else None
+
+try:
+   import concurrent.futures as futures
+except ImportError:
+   # Python 2 without the futures backport
+   futures = None
+
+# For SamplingBase's rate limits
+sampling_clock = getattr(time, "monotonic", time.time)
 
 class AspectBase(object):
    '''
    Base class for all aspects.
+
+   The weaver makes an instance for each target, so with many targets it
+   pays to declare `__slots__ = ()` in an aspect class (as the base classes
+   here do where they can), leaving its instances without a __dict__. An
+   aspect whose advice keeps no state per target and never looks at
+   self.next_callable or self.core_callable can go further and set
+   `stateless = True`: if its __call__ is inlinable (see ExecutionBase), the
+   weaver then makes a single instance, with None for both, and each target
+   just gets a generated function that calls its advice.
    '''
+   __slots__ = ("next_callable", "core_callable", "__weakref__")
+
+   # The functions and methods to wrap: either a list, or a pointcut from
+   # AOPy.pointcuts that is only resolved when the aspect is enabled
    targets = []
 
+   stateless = False
+
    def __init__(self, next_callable, core_callable):
       self.next_callable = next_callable
       self.core_callable = core_callable
    
    @classmethod
    def enable(cls):
-      for target in cls.targets:
-         install(cls, target)
+      with batch(cls.__name__ + ".enable"):
+         for target in cls.targets:
+            install(cls, target)
 
    @classmethod
    def disable(cls):
-      for target in cls.targets:
-         uninstall(cls, target)
+      with batch(cls.__name__ + ".disable"):
+         for target in cls.targets:
+            uninstall(cls, target)
 
    def before_advice(self, *args, **kwargs):
       pass
@@ -30,10 +81,33 @@ class AspectBase(object):
    def after_exception_advice(self, exception, *args, **kwargs):
       pass
 
+def enable_all(*aspects):
+   '''
+   Enable several aspects at once, in order, rebuilding each affected callable
+   only once and making all the changes visible together.
+   '''
+   with batch("enable_all"):
+      for aspect in aspects:
+         aspect.enable()
+
+def disable_all(*aspects):
+   '''
+   Disable several aspects at once; see enable_all.
+   '''
+   with batch("disable_all"):
+      for aspect in aspects:
+         aspect.disable()
+
 class ExecutionBase(AspectBase):
    '''
    Base class for wrapping advice around each individual call.
    '''
+   __slots__ = ()
+
+   # Tells the weaver that this __call__ only runs the advice around
+   # next_callable, so in compiled chain mode it can be inlined
+   inlinable = True
+
    def __call__(self, *args, **kwargs):
       self.before_advice(*args, **kwargs)
       try:
@@ -45,15 +119,27 @@ class ExecutionBase(AspectBase):
          self.after_advice(result, *args, **kwargs)
       return result
 
+   if coroutines is not None:
+      coroutine_wrapper = coroutines.execution_coroutine
+      async_generator_wrapper = coroutines.execution_async_generator
+
 class CallBase(AspectBase):
-   # This may be unnecessary as a base class. The advice methods in an
-   # ExecutionBase can simply call sys._getframe(2) on their own. I just haven't
-   # found a simple, readable, and efficient way to produce this behavior by
-   # simply parameterizing ExecutionBase, so it's a matter of taste. This aspect
-   # really should also maintain a mapping from the original code object to the
-   # original method object to make more debugging information available.
+   '''
+   Base class for advice that needs to know where each call comes from.
+
+   self.caller is the code object of the function that called the target. It
+   is only worked out when advice asks for it, by walking out of the wrapper
+   chain on the stack, so a CallBase aspect whose advice doesn't always look
+   costs no more than an ExecutionBase one; it is only meaningful while the
+   advice is running. self.caller_origin looks the caller up in
+   AOPy.codeindex to get its module, class and function, and
+   self.called_from checks the caller's module with a dict lookup.
+   '''
+   __slots__ = ()
+
+   inlinable = True
+
    def __call__(self, *args, **kwargs):
-      self.caller = sys._getframe(1).f_code
       self.before_advice(*args, **kwargs)
       try:
          result = self.next_callable(*args, **kwargs)
@@ -64,35 +150,345 @@ class CallBase(AspectBase):
          self.after_advice(result, *args, **kwargs)
       return result
 
+   @property
+   def caller(self):
+      frame = find_caller(sys._getframe(1))
+      return None if frame is None else frame.f_code
+
+   @property
+   def caller_origin(self):
+      frame = find_caller(sys._getframe(1))
+      return None if frame is None else codeindex.lookup(frame.f_code)
+
+   def called_from(self, *modules):
+      '''
+      Whether the current call comes from a function or method defined in
+      one of the named modules.
+      '''
+      frame = find_caller(sys._getframe(1))
+      if frame is None:
+         return False
+      entry = codeindex.index.entry(frame.f_code)
+      return entry is not None and entry[0] in modules
+
+   if coroutines is not None:
+      coroutine_wrapper = coroutines.execution_coroutine
+
+class JoinPoint(object):
+   '''
+   Everything about one invocation of a target, handed to JoinPointBase
+   advice: the args and kwargs it was called with, the target (the core
+   callable), the retval or exception it produced, the caller (worked out
+   when first asked for, as in CallBase) and a data slot that advice may use
+   for anything it wants to carry from before_advice to after_advice.
+
+   Join points are recycled once the invocation is over, so advice that wants
+   to hold on to one afterwards has to call keep() on it.
+   '''
+   __slots__ = ("args", "kwargs", "target", "retval", "exception", "data",
+                "_caller", "kept")
+
+   def __init__(self):
+      self.kept = False
+
+   @property
+   def caller(self):
+      if self._caller is _unknown:
+         frame = find_caller(sys._getframe(1))
+         self._caller = None if frame is None else frame.f_code
+      return self._caller
+
+   def keep(self):
+      '''
+      Take this join point out of circulation so it stays as it is.
+      '''
+      self.kept = True
+      return self
+
+# Stands in for a caller that hasn't been looked up yet
+_unknown = object()
+
+# Join points that are free to be reused. Lists are safe to pop and append
+# to from any thread, and since every invocation takes its own join point,
+# recursive and concurrent calls don't get in each other's way.
+_free_joinpoints = []
+MAX_FREE_JOINPOINTS = 64
+
+def acquire_joinpoint(target, args, kwargs):
+   try:
+      joinpoint = _free_joinpoints.pop()
+   except IndexError:
+      joinpoint = JoinPoint()
+   joinpoint.args = args
+   joinpoint.kwargs = kwargs
+   joinpoint.target = target
+   joinpoint.retval = None
+   joinpoint.exception = None
+   joinpoint.data = None
+   joinpoint._caller = _unknown
+   return joinpoint
+
+def release_joinpoint(joinpoint):
+   if joinpoint.kept:
+      return
+   # Don't keep anything from the call alive while the join point sits idle
+   joinpoint.args = joinpoint.kwargs = joinpoint.retval = None
+   joinpoint.exception = joinpoint.data = joinpoint._caller = None
+   if len(_free_joinpoints) < MAX_FREE_JOINPOINTS:
+      _free_joinpoints.append(joinpoint)
+
+class JoinPointBase(AspectBase):
+   '''
+   Base class for advice that works with a JoinPoint per invocation instead
+   of bare arguments: before_advice(self, joinpoint), after_advice(self,
+   joinpoint) and after_exception_advice(self, joinpoint). Since the aspect
+   instance is shared by every invocation of its target, per-call state (a
+   start time, say) belongs in joinpoint.data rather than on self.
+   '''
+   __slots__ = ()
+
+   def __call__(self, *args, **kwargs):
+      joinpoint = acquire_joinpoint(self.core_callable, args, kwargs)
+      try:
+         self.before_advice(joinpoint)
+         try:
+            result = self.next_callable(*args, **kwargs)
+         except Exception as e:
+            joinpoint.exception = e
+            self.after_exception_advice(joinpoint)
+            raise
+         else:
+            joinpoint.retval = result
+            self.after_advice(joinpoint)
+         return result
+      finally:
+         release_joinpoint(joinpoint)
+
+   if coroutines is not None:
+      coroutine_wrapper = coroutines.joinpoint_coroutine
+
+class GeneratorBase(AspectBase):
+   '''
+   Base class for wrapping advice around generator functions. Rather than
+   seeing an unstarted generator object in after_advice, aspects get to
+   observe the stream as it is consumed:
+
+   before_advice runs when the generator function is called
+   on_item runs for each item, just before it is handed to the consumer
+   on_exhaust runs with the generator's return value when it is exhausted
+   on_close runs if the consumer closes (or drops) it before exhaustion
+   after_exception_advice runs if the generator raises
+
+   Items are passed through one at a time as they are produced, and send and
+   throw go straight to the underlying generator. If an aspect overrides none
+   of the hooks, the generator is returned unwrapped and items cost nothing
+   extra.
+   '''
+   __slots__ = ()
+
+   # Same trick as in DepthBase, to work out once per aspect class which hooks
+   # actually need to be called
+   def __new__(cls, *args, **kwargs):
+      if "_hooks" not in vars(cls):
+         cls._hooks = tuple(
+            getattr(getattr(cls, name), "__func__", getattr(cls, name))
+            is not getattr(getattr(GeneratorBase, name), "__func__",
+                           getattr(GeneratorBase, name))
+            for name in ("on_item", "on_exhaust", "on_close",
+                         "after_exception_advice"))
+      return super(GeneratorBase, cls).__new__(cls)
+
+   def __call__(self, *args, **kwargs):
+      self.before_advice(*args, **kwargs)
+      try:
+         generator = self.next_callable(*args, **kwargs)
+      except Exception as e:
+         self.after_exception_advice(e, *args, **kwargs)
+         raise
+      if not any(self._hooks):
+         return generator
+      return AdvisedGenerator(self, generator, args, kwargs)
+
+   def on_item(self, item, *args, **kwargs):
+      pass
+
+   def on_exhaust(self, retval, *args, **kwargs):
+      pass
+
+   def on_close(self, *args, **kwargs):
+      pass
+
+class AdvisedGenerator(object):
+   '''
+   Generator-like proxy that GeneratorBase hands out in place of the
+   generator it advises.
+   '''
+   __slots__ = ("aspect", "generator", "args", "kwargs", "on_item", "done")
+
+   def __init__(self, aspect, generator, args, kwargs):
+      self.aspect = aspect
+      self.generator = generator
+      self.args = args
+      self.kwargs = kwargs
+      self.on_item = aspect.on_item if aspect._hooks[0] else None
+      self.done = False
+
+   def __iter__(self):
+      return self
+
+   def _advance(self, resume, *resume_args):
+      if self.done:
+         raise StopIteration
+      try:
+         item = resume(*resume_args)
+      except StopIteration as e:
+         self.done = True
+         self.aspect.on_exhaust(getattr(e, "value", None),
+                                *self.args, **self.kwargs)
+         raise
+      except Exception as e:
+         self.done = True
+         self.aspect.after_exception_advice(e, *self.args, **self.kwargs)
+         raise
+      if self.on_item is not None:
+         self.on_item(item, *self.args, **self.kwargs)
+      return item
+
+   def __next__(self):
+      # Same as _advance, spelled out since this is the path every item takes
+      if self.done:
+         raise StopIteration
+      try:
+         item = next(self.generator)
+      except StopIteration as e:
+         self.done = True
+         self.aspect.on_exhaust(getattr(e, "value", None),
+                                *self.args, **self.kwargs)
+         raise
+      except Exception as e:
+         self.done = True
+         self.aspect.after_exception_advice(e, *self.args, **self.kwargs)
+         raise
+      if self.on_item is not None:
+         self.on_item(item, *self.args, **self.kwargs)
+      return item
+
+   next = __next__
+
+   def send(self, value):
+      return self._advance(self.generator.send, value)
+
+   def throw(self, *exc_info):
+      return self._advance(self.generator.throw, *exc_info)
+
+   def close(self):
+      if not self.done:
+         self.done = True
+         self.generator.close()
+         self.aspect.on_close(*self.args, **self.kwargs)
+
+   def __del__(self):
+      # Real generators are closed when they're garbage collected, and
+      # consumers that break out of a loop early rely on that
+      self.close()
+
+if sys.version_info >= (3, 5):
+   from collections.abc import Generator
+   Generator.register(AdvisedGenerator)
+
 class DepthBase(AspectBase):
    '''
    Base class for aspects that track the depth of the call stack.
    '''
-   # We use this trick to avoid using metaclasses or requiring the user to
-   # remember to call the super's __init__ method when subclassing:
-   # http://docs.python.org/2/reference/simple_stmts.html#attr-target-note
-   #
-   # The right way to do this is with metaclasses, but Tim Peters has scared
-   # enough people away from them that I thought it better to use this horrible
-   # hack instead. It's rather unpythonic, but then so is Python in this case.
-   depth = 0
+   __slots__ = ()
+
+   # Each concrete aspect class needs a depth counter of its own, private to
+   # the current thread and task. Creating it in __new__ means we still avoid
+   # using metaclasses or requiring the user to remember to call the super's
+   # __init__ method when subclassing, and instances are only ever created by
+   # the weaver, so this costs nothing per call.
+   def __new__(cls, *args, **kwargs):
+      if "_depth" not in vars(cls):
+         cls._depth = ContextVar(cls.__name__ + ".depth", default=0)
+      return super(DepthBase, cls).__new__(cls)
 
    def __call__(self, *args, **kwargs):
       self.before_advice(*args, **kwargs)
-      self.__class__.depth += 1
+      depth = self._depth
+      token = depth.set(depth.get() + 1)
       try:
          result = self.next_callable(*args, **kwargs)
       except Exception as e:
-         self.__class__.depth -= 1
+         depth.reset(token)
          self.after_exception_advice(e, *args, **kwargs)
          raise
       else:
-         self.__class__.depth -= 1
+         depth.reset(token)
          self.after_advice(result, *args, **kwargs)
       return result
 
+   if task_coroutines is not None:
+      coroutine_wrapper = task_coroutines.depth_coroutine
+      async_generator_wrapper = task_coroutines.depth_async_generator
+
+   @property
+   def depth(self):
+      return self._depth.get()
+
    def active(self):
-      return self.__class__.depth > 0
+      return self.depth > 0
+
+class TraceBase(DepthBase):
+   '''
+   Base class for aspects that trace every call to their targets into an
+   AOPy.tracing.TraceRecorder, e.g.
+
+      class Trace(TraceBase):
+         targets = within("sample_classes")
+         recorder = tracing.TraceRecorder("trace.bin")
+
+   Each call, return and exception costs one fixed-size binary record in the
+   recorder's ring buffer rather than a formatted print, which makes full
+   tracing cheap enough to leave on; decode the file afterwards with
+   `python -m AOPy.tracing trace.bin`. The recorder has to be set before the
+   aspect is enabled. Recording is all a TraceBase aspect does: none of the
+   advice methods are called, to keep the cost per call down.
+   '''
+   __slots__ = ("_record", "_joinpoint")
+
+   recorder = None
+
+   def __init__(self, next_callable, core_callable):
+      super(TraceBase, self).__init__(next_callable, core_callable)
+      if self.recorder is None:
+         raise ValueError("%s has no recorder to trace into"
+                          % type(self).__name__)
+      try:
+         name = ".".join(part for part in get_key(core_callable) if part)
+      except ValueError:
+         name = repr(core_callable)
+      self._record = self.recorder.record
+      self._joinpoint = self.recorder.joinpoint_id(name)
+
+   def __call__(self, *args, **kwargs):
+      record = self._record
+      depth = self._depth
+      level = depth.get()
+      record(tracing.ENTER, self._joinpoint, level)
+      token = depth.set(level + 1)
+      try:
+         result = self.next_callable(*args, **kwargs)
+      except Exception:
+         depth.reset(token)
+         record(tracing.EXCEPTION, self._joinpoint, level)
+         raise
+      depth.reset(token)
+      record(tracing.EXIT, self._joinpoint, level)
+      return result
+
+   if task_coroutines is not None:
+      coroutine_wrapper = task_coroutines.trace_coroutine
+      async_generator_wrapper = task_coroutines.trace_async_generator
 
 class CFlowMeta(type):
    def __new__(meta, classname, supers, classdict):
@@ -103,56 +499,1050 @@ class CFlowBase(AspectBase):
    '''
    Base class for cflow-style aspects.
    This may be something of a misnomer. More specifically, it behaves like
-   execution(pointcut) && !cflowbelow(execution(pointcut)) in AspectJ terms. The
-   before and after advice runs only around targets that are not called as a
-   consequence of any other target. This behavior could be implemented on an
+   execution(pointcut) && !cflowbelow(execution(pointcut)) in AspectJ terms.
+   The before and after advice runs only around targets that are not called as
+   a consequence of any other target. This behavior could be implemented on an
    ExecutionBase-derived class by checking the boolean flag from within the
-   advice methods, but this way we save a bunch of do-nothing function calls. I
-   haven't yet checked whether this has a significant impact on performance in
-   deep call stacks.
+   advice methods, but this way we save a bunch of do-nothing function calls.
+   It does pay off in deep call stacks, where a nested call only checks the
+   flag and goes straight on to next_callable, without calling any advice;
+   benchmarks/bench_overhead.py compares it with ExecutionBase.
    '''
+   __slots__ = ()
+
    # Same trick as in DepthBase.
-   within_cflow = False
+   def __new__(cls, *args, **kwargs):
+      if "_within_cflow" not in vars(cls):
+         cls._within_cflow = ContextVar(cls.__name__ + ".within_cflow",
+                                        default=False)
+      return super(CFlowBase, cls).__new__(cls)
 
    def __call__(self, *args, **kwargs):
-      if self.__class__.within_cflow:
+      within_cflow = self._within_cflow
+      if within_cflow.get():
          return self.next_callable(*args, **kwargs)
       else:
          self.before_advice(*args, **kwargs)
-         self.__class__.within_cflow = True
+         token = within_cflow.set(True)
+         try:
+            result = self.next_callable(*args, **kwargs)
+         except Exception as e:
+            within_cflow.reset(token)
+            self.after_exception_advice(e, *args, **kwargs)
+            raise
+         else:
+            within_cflow.reset(token)
+            self.after_advice(result, *args, **kwargs)
+         return result
+
+   if task_coroutines is not None:
+      coroutine_wrapper = task_coroutines.cflow_coroutine
+      async_generator_wrapper = task_coroutines.cflow_async_generator
+
+   @property
+   def within_cflow(self):
+      return self._within_cflow.get()
+
+   def active(self):
+      return self.within_cflow
+
+class CoalescingBase(CFlowBase):
+   '''
+   Base class for observer-style aspects whose side effect (a redraw, say)
+   should happen once for a whole group of top level calls rather than once
+   per call. Instead of after_advice, define the classmethod
+
+      coalesced_advice(cls, affected)
+
+   where affected lists the objects the calls since the last run affected,
+   each one once, in the order they were first affected. By default that is
+   each call's first argument (self, for methods); override affected() to
+   pick something else. Calls are grouped:
+
+   - inside a `with SomeAspect.coalescing():` block, until the outermost
+     block for the current thread or task ends;
+   - otherwise, if coalesce_window is a number of seconds, over that long
+     after the first call, with coalesced_advice run on a timer thread;
+   - otherwise, if coalesce_on_loop is set and an asyncio event loop is
+     running, until the loop's next iteration;
+   - otherwise not at all: coalesced_advice runs after each top level call,
+     as after_advice would.
+
+   As in CFlowBase, calls made as a consequence of another call to one of
+   the targets are never advised.
+   '''
+   coalesce_window = None
+   coalesce_on_loop = False
+
+   # Same trick as in DepthBase, except that the batch helpers can be called
+   # before any instance exists, so they set things up too
+   def __new__(cls, *args, **kwargs):
+      cls.setup_coalescing()
+      return super(CoalescingBase, cls).__new__(cls)
+
+   @classmethod
+   def setup_coalescing(cls):
+      if "_batch" not in vars(cls):
+         cls._batch = ContextVar(cls.__name__ + ".batch", default=None)
+         # Calls made outside a batch, waiting for the window or the event
+         # loop; guarded by _pending_lock
+         cls._pending = collections.OrderedDict()
+         cls._pending_lock = threading.Lock()
+         cls._scheduled = False
+
+   def affected(self, retval, *args, **kwargs):
+      '''
+      The object a top level call affected.
+      '''
+      return args[0] if args else self.core_callable
+
+   @classmethod
+   def coalesced_advice(cls, affected):
+      pass
+
+   def after_advice(self, retval, *args, **kwargs):
+      affected = self.affected(retval, *args, **kwargs)
+      batch = self._batch.get()
+      if batch is not None:
+         batch.setdefault(id(affected), affected)
+         return
+      cls = type(self)
+      loop = None
+      if cls.coalesce_window is None:
+         if cls.coalesce_on_loop:
+            loop = running_loop()
+         if loop is None:
+            cls.coalesced_advice([affected])
+            return
+      with cls._pending_lock:
+         cls._pending.setdefault(id(affected), affected)
+         if cls._scheduled:
+            return
+         cls._scheduled = True
+      if loop is not None:
+         loop.call_soon(cls.flush)
+      else:
+         timer = threading.Timer(cls.coalesce_window, cls.flush)
+         timer.daemon = True
+         timer.start()
+
+   @classmethod
+   def flush(cls):
+      '''
+      Run coalesced_advice now for the calls waiting for a window or the event
+      loop, if there are any.
+      '''
+      cls.setup_coalescing()
+      with cls._pending_lock:
+         pending = cls._pending
+         cls._pending = collections.OrderedDict()
+         cls._scheduled = False
+      if pending:
+         cls.coalesced_advice(list(pending.values()))
+
+   @classmethod
+   @contextlib.contextmanager
+   def coalescing(cls):
+      '''
+      Group every top level call made in the current thread or task until the
+      block ends into one run of coalesced_advice. Blocks can be nested.
+      '''
+      cls.setup_coalescing()
+      if cls._batch.get() is not None:
+         yield
+         return
+      batch = collections.OrderedDict()
+      token = cls._batch.set(batch)
+      try:
+         yield
+      finally:
+         cls._batch.reset(token)
+         if batch:
+            cls.coalesced_advice(list(batch.values()))
+
+def running_loop():
+   '''
+   The asyncio event loop running in the current thread, if any.
+   '''
+   # Nothing can be running an event loop if asyncio was never imported
+   asyncio = sys.modules.get("asyncio")
+   if asyncio is None:
+      return None
+   return asyncio._get_running_loop()
+
+class SamplingBase(AspectBase):
+   '''
+   Base class for aspects that should only run their advice on a sample of
+   calls, e.g. tracing under production load. Set one of
+
+   sample_every = N: advise every Nth call to each target
+   sample_probability = p: advise each call with probability p
+   sample_rate = r: advise at most r calls per second to each target, with
+      bursts of up to sample_burst calls
+
+   Calls that aren't sampled only count down a counter before going straight
+   to next_callable. Once a call is sampled, every call to any of this
+   aspect's targets made within it is advised too, so a sampled call gets a
+   complete trace of what happens beneath it; self.depth tells how deep in
+   that trace the current call is (0 for the sampled call itself).
+   '''
+   __slots__ = ("_tokens", "_checked", "_skip", "_countdown")
+
+   sample_every = None
+   sample_probability = None
+   sample_rate = None
+   sample_burst = 1.0
+
+   # Same trick as in DepthBase. The counter holds the depth within a sampled
+   # call, and is 0 everywhere else.
+   def __new__(cls, *args, **kwargs):
+      if "_sampled" not in vars(cls):
+         cls._sampled = ContextVar(cls.__name__ + ".sampled", default=0)
+      return super(SamplingBase, cls).__new__(cls)
+
+   def __init__(self, next_callable, core_callable):
+      super(SamplingBase, self).__init__(next_callable, core_callable)
+      modes = [mode for mode in (self.sample_every, self.sample_probability,
+                                 self.sample_rate) if mode is not None]
+      if len(modes) != 1:
+         raise ValueError("%s needs exactly one of sample_every, "
+                          "sample_probability and sample_rate"
+                          % type(self).__name__)
+      if self.sample_rate is not None:
+         self._tokens = float(self.sample_burst)
+         self._checked = sampling_clock()
+         self._skip = 1
+         # The first call is always considered, to get the bucket going
+         self._countdown = 1
+      else:
+         self._countdown = self.draw_countdown()
+
+   def __call__(self, *args, **kwargs):
+      sampled = self._sampled
+      depth = sampled.get()
+      if not depth:
+         # Other threads may count down at the same time, which can only
+         # make the sample a little bigger or smaller
+         self._countdown -= 1
+         if self._countdown > 0:
+            return self.next_callable(*args, **kwargs)
+         if not self.take_sample():
+            return self.next_callable(*args, **kwargs)
+      token = sampled.set(depth + 1)
+      try:
+         self.before_advice(*args, **kwargs)
          try:
             result = self.next_callable(*args, **kwargs)
          except Exception as e:
-            self.__class__.within_cflow = False
             self.after_exception_advice(e, *args, **kwargs)
             raise
          else:
-            self.__class__.within_cflow = False
             self.after_advice(result, *args, **kwargs)
          return result
+      finally:
+         sampled.reset(token)
+
+   def take_sample(self):
+      '''
+      Called when the countdown runs out: set the next countdown and decide
+      whether this call is sampled.
+      '''
+      if self.sample_rate is None:
+         self._countdown = self.draw_countdown()
+         return self.sample_every is not None or self.sample_probability > 0
+      # A token bucket, checked only as often as the calls that went by since
+      # the last check suggest it will take for the next token to arrive
+      now = sampling_clock()
+      elapsed = now - self._checked
+      self._checked = now
+      rate = self.sample_rate
+      self._tokens = min(float(self.sample_burst),
+                         self._tokens + elapsed * rate)
+      taken = self._tokens >= 1
+      if taken:
+         self._tokens -= 1
+      wait = max(0.0, (1 - self._tokens) / rate)
+      # The estimate is only as good as the last interval, and a burst after
+      # a quiet spell would otherwise have us skip a million calls that may
+      # then take ages to come, so it may at most double from one check to
+      # the next
+      if elapsed > 0:
+         self._skip = max(1, min(int(self._skip / elapsed * wait),
+                                 2 * self._skip, 1000000))
+      else:
+         self._skip = 1
+      self._countdown = self._skip
+      return taken
+
+   def draw_countdown(self):
+      '''
+      How many calls from now the next sampled one is, with sample_every or
+      sample_probability.
+      '''
+      if self.sample_every is not None:
+         return self.sample_every
+      p = self.sample_probability
+      if p <= 0:
+         # Never; take_sample won't sample it if we do get that far
+         return sys.maxsize
+      if p >= 1:
+         return 1
+      # The gap to the next sampled call is geometrically distributed, so
+      # we draw that instead of a random number per call
+      return int(math.log(1.0 - random.random()) / math.log(1.0 - p)) + 1
+
+   if task_coroutines is not None:
+      coroutine_wrapper = task_coroutines.sampling_coroutine
+
+   @property
+   def depth(self):
+      return max(0, self._sampled.get() - 1)
 
    def active(self):
-      return self.__class__.within_cflow
+      return self._sampled.get() > 0
+
+class CachingBase(AspectBase):
+   '''
+   Base class for aspects that memoize their targets' results, keyed on the
+   arguments, e.g.
+
+      class AreaCache(CachingBase):
+         targets = within("shapes") & named("area", "perimeter")
+         invalidated_by = within("shapes") & named("move_*", "set_*")
+
+   Methods get a cache per instance, keyed on the remaining arguments and
+   holding only a weak reference to the instance, so caching never keeps an
+   object alive. Functions get one cache, which like functools.lru_cache
+   holds on to the arguments it is keyed on. Each cache keeps at most
+   cache_size results (None for no limit), dropping the least recently used
+   first, and results older than cache_ttl seconds (if set) are recomputed.
+   Calls with unhashable arguments and calls that raise aren't cached. No
+   advice methods are run.
+
+   invalidated_by is a second set of targets, as a list or a pointcut. After
+   each call to one of those, everything cached for its first argument (the
+   instance, for methods) is evicted: the instance's own cache, and the
+   results of functions called with it as their first argument. The aspect
+   enables and disables a CacheInvalidator aspect for this along with
+   itself. invalidate() can also be called directly.
+   '''
+   cache_size = 128
+   cache_ttl = None
+   invalidated_by = None
+
+   # Same trick as in DepthBase: each concrete aspect class keeps track of its
+   # own instances, so that invalidation can find their caches
+   def __new__(cls, *args, **kwargs):
+      if "_instances" not in vars(cls):
+         cls._instances = weakref.WeakSet()
+      return super(CachingBase, cls).__new__(cls)
+
+   def __init__(self, next_callable, core_callable):
+      super(CachingBase, self).__init__(next_callable, core_callable)
+      self.per_instance = get_key(core_callable)[1] is not None
+      # For functions, and for instances that can't be weakly referenced
+      self.shared = collections.OrderedDict()
+      # id(instance) -> (weakref to instance, cache)
+      self.caches = {}
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+      self._instances.add(self)
+
+   @classmethod
+   def enable(cls):
+      with batch(cls.__name__ + ".enable"):
+         super(CachingBase, cls).enable()
+         invalidator = cls.invalidator()
+         if invalidator is not None:
+            invalidator.enable()
+
+   @classmethod
+   def disable(cls):
+      with batch(cls.__name__ + ".disable"):
+         invalidator = cls.invalidator()
+         if invalidator is not None:
+            invalidator.disable()
+         super(CachingBase, cls).disable()
+
+   @classmethod
+   def invalidator(cls):
+      '''
+      The CacheInvalidator aspect for invalidated_by, or None.
+      '''
+      if cls.invalidated_by is None:
+         return None
+      if "_invalidator" not in vars(cls):
+         cls._invalidator = type(cls.__name__ + "Invalidator",
+                                 (CacheInvalidator,),
+                                 {"targets": cls.invalidated_by,
+                                  "caching_aspect": cls,
+                                  "__module__": cls.__module__})
+      return cls._invalidator
+
+   def cache_key(self, args, kwargs):
+      '''
+      Find the cache for a call and the key of its result there.
+      '''
+      cache = self.shared
+      if self.per_instance and args:
+         instance = args[0]
+         entry = self.caches.get(id(instance))
+         if entry is not None and entry[0]() is instance:
+            cache = entry[1]
+            args = args[1:]
+         else:
+            try:
+               ref = weakref.ref(instance, self.forget_instance(id(instance)))
+            except TypeError:
+               pass
+            else:
+               cache = collections.OrderedDict()
+               self.caches[id(instance)] = (ref, cache)
+               args = args[1:]
+      if kwargs:
+         args += (_kwargs_mark,) + tuple(sorted(kwargs.items()))
+      return cache, args
+
+   def forget_instance(self, key):
+      def forget(ref):
+         entry = self.caches.get(key)
+         if entry is not None and entry[0] is ref:
+            del self.caches[key]
+      return forget
+
+   def __call__(self, *args, **kwargs):
+      cache, key = self.cache_key(args, kwargs)
+      try:
+         value, expires = cache.pop(key)
+      except KeyError:
+         pass
+      except TypeError:
+         # Unhashable arguments
+         return self.next_callable(*args, **kwargs)
+      else:
+         if expires is None or expires > sampling_clock():
+            # Put it back as the most recently used
+            cache[key] = (value, expires)
+            self.hits += 1
+            return value
+         self.evictions += 1
+      self.misses += 1
+      value = self.next_callable(*args, **kwargs)
+      self.store(cache, key, value)
+      return value
+
+   if coroutines is not None:
+      coroutine_wrapper = coroutines.caching_coroutine
+
+   def store(self, cache, key, value):
+      ttl = self.cache_ttl
+      cache[key] = (value, None if ttl is None else sampling_clock() + ttl)
+      if self.cache_size is not None:
+         while len(cache) > self.cache_size:
+            try:
+               cache.popitem(last=False)
+            except KeyError:
+               # Another thread got there first
+               break
+            self.evictions += 1
+
+   def evict(self, instance):
+      '''
+      Drop everything cached for instance.
+      '''
+      entry = self.caches.pop(id(instance), None)
+      if entry is not None and entry[0]() is not instance:
+         # Someone else's cache, left behind by a dead instance with the
+         # same id whose weakref callback hasn't run yet
+         entry = None
+      dropped = 0 if entry is None else len(entry[1])
+      stale = [key for key in list(self.shared)
+               if key and key[0] is instance]
+      for key in stale:
+         if self.shared.pop(key, None) is not None:
+            dropped += 1
+      self.evictions += dropped
+
+   def clear(self):
+      self.evictions += len(self.shared) + sum(
+         len(cache) for ref, cache in list(self.caches.values()))
+      self.shared.clear()
+      self.caches.clear()
+
+   @classmethod
+   def invalidate(cls, instance=None):
+      '''
+      Evict the results cached for instance (as in invalidated_by), or
+      everything if no instance is given.
+      '''
+      for aspect_instance in list(vars(cls).get("_instances", ())):
+         if instance is None:
+            aspect_instance.clear()
+         else:
+            aspect_instance.evict(instance)
+
+   @classmethod
+   def cache_stats(cls):
+      '''
+      Hits, misses, evictions and the number of cached results, over all
+      of this aspect's targets.
+      '''
+      stats = {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+      for aspect_instance in list(vars(cls).get("_instances", ())):
+         stats["hits"] += aspect_instance.hits
+         stats["misses"] += aspect_instance.misses
+         stats["evictions"] += aspect_instance.evictions
+         stats["size"] += len(aspect_instance.shared) + sum(
+            len(cache) for ref, cache in list(
+               aspect_instance.caches.values()))
+      return stats
+
+# Separates positional from keyword arguments in cache keys
+_kwargs_mark = object()
+
+class CacheInvalidator(ExecutionBase):
+   '''
+   Evicts the results of caching_aspect that a call to one of its targets
+   may have made stale; see CachingBase.invalidated_by, which generates one
+   of these for each caching aspect that needs it.
+   '''
+   __slots__ = ()
+
+   caching_aspect = None
+   stateless = True
+
+   def after_advice(self, retval, *args, **kwargs):
+      self.evict(args)
+
+   def after_exception_advice(self, exception, *args, **kwargs):
+      # It may have changed something before it failed
+      self.evict(args)
+
+   def evict(self, args):
+      if args:
+         self.caching_aspect.invalidate(args[0])
+      else:
+         self.caching_aspect.invalidate()
+
+class OffloadBase(AspectBase):
+   '''
+   Base class for aspects that run their targets on a concurrent.futures
+   pool instead of in the calling thread, e.g. to move blocking or CPU-heavy
+   methods off a request thread. The pool is executor if that is set, and
+   otherwise one the aspect class creates when first needed: a thread pool,
+   or a process pool if pool = "process", with max_workers workers. What a
+   call returns depends on offload_mode:
+
+   "wait": the target's result, once the pool has run it
+   "future": a concurrent.futures.Future for the result
+   "async": an asyncio future for the result, to be awaited on the event
+      loop the call was made from; calls made while no event loop is
+      running in the calling thread raise RuntimeError
+
+   before_advice runs in the calling thread before the call is handed to the
+   pool. after_advice and after_exception_advice run once it is done, in the
+   calling thread for "wait" and otherwise as soon as the pool finishes, on
+   the worker thread; the future is only resolved after they have run, and
+   fails with whatever they raise. If max_concurrent is set, callers block
+   while that many calls made through the aspect are in flight.
+
+   On a thread pool, next_callable runs in the worker, so aspects inside this
+   one still apply, and calls to the targets made from a worker run right
+   there instead of being offloaded again. Process pools are sent the
+   target's location and arguments, which have to be picklable, and run the
+   bare target without any aspects.
+   '''
+   executor = None
+   pool = "thread"
+   max_workers = None
+   offload_mode = "wait"
+   max_concurrent = None
+
+   # Same trick as in DepthBase, for the concurrency limit
+   def __new__(cls, *args, **kwargs):
+      if "_in_flight" not in vars(cls):
+         cls._in_flight = (None if cls.max_concurrent is None else
+                           threading.BoundedSemaphore(cls.max_concurrent))
+      return super(OffloadBase, cls).__new__(cls)
+
+   def __init__(self, next_callable, core_callable):
+      super(OffloadBase, self).__init__(next_callable, core_callable)
+      if futures is None:
+         raise ImportError("%s needs concurrent.futures (the futures package "
+                           "on Python 2)" % type(self).__name__)
+      if self.offload_mode not in ("wait", "future", "async"):
+         raise ValueError("unknown offload_mode %r" % (self.offload_mode,))
+      if self.offload_mode == "async" and coroutines is None:
+         raise ValueError("offload_mode 'async' needs Python 3.6 or later")
+      self.key = get_key(core_callable)
+
+   @classmethod
+   def get_executor(cls):
+      if cls.executor is not None:
+         return cls.executor
+      with _executor_lock:
+         if vars(cls).get("_executor") is None:
+            if cls.pool == "process":
+               cls._executor = futures.ProcessPoolExecutor(cls.max_workers)
+            elif cls.pool == "thread":
+               cls._executor = futures.ThreadPoolExecutor(cls.max_workers)
+            else:
+               raise ValueError("unknown pool %r" % (cls.pool,))
+         return cls._executor
+
+   @classmethod
+   def shutdown(cls, wait=True):
+      '''
+      Shut down the pool the aspect class created, if any. Another one is
+      created if the targets are called again.
+      '''
+      with _executor_lock:
+         executor = vars(cls).get("_executor")
+         cls._executor = None
+      if executor is not None:
+         executor.shutdown(wait)
+
+   def submit(self, args, kwargs):
+      executor = self.get_executor()
+      in_flight = self._in_flight
+      if in_flight is not None:
+         in_flight.acquire()
+      try:
+         if isinstance(executor, futures.ProcessPoolExecutor):
+            future = executor.submit(call_core, self.key, args, kwargs)
+         else:
+            future = executor.submit(run_offloaded, self.next_callable, args,
+                                     kwargs)
+      except BaseException:
+         if in_flight is not None:
+            in_flight.release()
+         raise
+      if in_flight is not None:
+         future.add_done_callback(lambda future: in_flight.release())
+      return future
+
+   def __call__(self, *args, **kwargs):
+      if getattr(_worker, "active", False):
+         # Waiting for another worker from here could deadlock the pool
+         self.before_advice(*args, **kwargs)
+         try:
+            result = self.next_callable(*args, **kwargs)
+         except Exception as e:
+            self.after_exception_advice(e, *args, **kwargs)
+            raise
+         self.after_advice(result, *args, **kwargs)
+         return result
+      if self.offload_mode == "async":
+         loop = running_loop()
+         if loop is None:
+            # Checked before anything runs, so the call isn't made without
+            # anyone to hand the result to
+            raise RuntimeError("%s needs a running asyncio event loop to "
+                               "call %s with offload_mode 'async'"
+                               % (type(self).__name__,
+                                  self.core_callable.__name__))
+      self.before_advice(*args, **kwargs)
+      future = self.submit(args, kwargs)
+      if self.offload_mode == "wait":
+         try:
+            result = future.result()
+         except Exception as e:
+            self.after_exception_advice(e, *args, **kwargs)
+            raise
+         self.after_advice(result, *args, **kwargs)
+         return result
+      advised = futures.Future()
+      def finish(future):
+         if future.cancelled():
+            advised.cancel()
+            return
+         try:
+            exception = future.exception()
+            if exception is not None:
+               self.after_exception_advice(exception, *args, **kwargs)
+            else:
+               self.after_advice(future.result(), *args, **kwargs)
+         except Exception as e:
+            exception = e
+         if exception is not None:
+            advised.set_exception(exception)
+         else:
+            advised.set_result(future.result())
+      future.add_done_callback(finish)
+      if self.offload_mode == "future":
+         return advised
+      # asyncio is already imported, or no loop could be running
+      import asyncio
+      return asyncio.wrap_future(advised, loop=loop)
+
+_executor_lock = threading.Lock()
+
+# Marks pool threads running an offloaded call
+_worker = threading.local()
+
+def run_offloaded(callable_, args, kwargs):
+   _worker.active = True
+   try:
+      return callable_(*args, **kwargs)
+   finally:
+      _worker.active = False
+
+def call_core(key, args, kwargs):
+   '''
+   Call the core callable at key with no aspects around it. This is what
+   OffloadBase sends to process pool workers, since the wrapper chain can't
+   be pickled; a forked worker may have inherited the weaving, so it has to
+   look in the registry first.
+   '''
+   location = weaver.registry.get(key)
+   if location is not None:
+      target = location.core_callable
+   else:
+      module = importlib.import_module(key[0])
+      target = getattr(find_owner(module, key[1]), key[2])
+   return target(*args, **kwargs)
+
+class BatchingBase(AspectBase):
+   '''
+   Base class for aspects that collect calls to a fine-grained target and
+   dispatch them together through
+
+      bulk_call(self, calls)
+
+   which gets a list of BatchedCalls (each with the args and kwargs of one
+   call, in the order they were made) and returns a list with a result for
+   each. It runs once per target per batch; the default just makes the calls
+   one by one. If it raises, every call in the batch fails with that
+   exception. No other advice is run. Calls are collected:
+
+   - inside a `with SomeAspect.batching():` block, where each call returns
+     its BatchedCall straight away and the batch is dispatched when the
+     outermost block for the current thread or task ends (then, if any batch
+     failed, the block raises the first exception). BatchedCall.result()
+     gives the result after that;
+   - otherwise, if batch_window is a number of seconds, from all threads for
+     that long after the first call, and each caller waits for the batch and
+     gets its own result back as usual;
+   - otherwise not at all.
+
+   batch_size, if set, dispatches a batch as soon as it has that many calls.
+   '''
+   batch_window = None
+   batch_size = None
+
+   # Same trick as in CoalescingBase
+   def __new__(cls, *args, **kwargs):
+      cls.setup_batching()
+      return super(BatchingBase, cls).__new__(cls)
+
+   @classmethod
+   def setup_batching(cls):
+      if "_scope" not in vars(cls):
+         cls._scope = ContextVar(cls.__name__ + ".scope", default=None)
+
+   def __init__(self, next_callable, core_callable):
+      super(BatchingBase, self).__init__(next_callable, core_callable)
+      # The batch collecting calls for batch_window, guarded by _lock
+      self._open = None
+      self._lock = threading.Lock()
+
+   def bulk_call(self, calls):
+      return [self.next_callable(*call.args, **call.kwargs) for call in calls]
+
+   def __call__(self, *args, **kwargs):
+      scope = self._scope.get()
+      if scope is not None:
+         call = BatchedCall(args, kwargs)
+         calls = scope.calls.setdefault(self, [])
+         calls.append(call)
+         if self.batch_size is not None and len(calls) >= self.batch_size:
+            del scope.calls[self]
+            error = self.dispatch(calls)
+            if error is not None:
+               # The block raises it when it ends, like the batches it ends
+               scope.errors.append(error)
+         return call
+      if self.batch_window is None:
+         return self.next_callable(*args, **kwargs)
+      call = BatchedCall(args, kwargs)
+      with self._lock:
+         batch = self._open
+         leader = batch is None
+         if leader:
+            batch = self._open = WindowBatch()
+         batch.calls.append(call)
+         full = (self.batch_size is not None
+                 and len(batch.calls) >= self.batch_size)
+         if full:
+            self._open = None
+      if full:
+         try:
+            self.dispatch(batch.calls)
+         finally:
+            batch.dispatched.set()
+      elif leader:
+         # The first caller waits out the window and dispatches the batch,
+         # unless it fills up first
+         taken = False
+         try:
+            if not batch.dispatched.wait(self.batch_window):
+               with self._lock:
+                  taken = self._open is batch
+                  if taken:
+                     self._open = None
+               if taken:
+                  self.dispatch(batch.calls)
+         except BaseException as e:
+            # If we were interrupted while waiting, nobody else will
+            # dispatch the batch, so the other callers get our exception
+            with self._lock:
+               if self._open is batch:
+                  self._open = None
+                  taken = True
+            if taken:
+               fail_calls(batch.calls, e)
+            raise
+         finally:
+            if taken:
+               batch.dispatched.set()
+         if not taken:
+            batch.dispatched.wait()
+      else:
+         batch.dispatched.wait()
+      return call.result()
+
+   def dispatch(self, calls):
+      '''
+      Run bulk_call on calls and hand out the results. If it fails, every
+      call gets the exception, which is returned, or raised again if it
+      isn't an Exception (say, a KeyboardInterrupt).
+      '''
+      try:
+         results = self.bulk_call(calls)
+         if len(results) != len(calls):
+            raise ValueError("%s.bulk_call returned %d results for %d calls"
+                             % (type(self).__name__, len(results),
+                                len(calls)))
+      except BaseException as e:
+         fail_calls(calls, e)
+         if not isinstance(e, Exception):
+            raise
+         return e
+      for call, result in zip(calls, results):
+         call.value = result
+         call.done = True
+      return None
+
+   @classmethod
+   @contextlib.contextmanager
+   def batching(cls):
+      '''
+      Collect the calls to this aspect's targets made in the current thread or
+      task until the block ends. Blocks can be nested.
+      '''
+      cls.setup_batching()
+      if cls._scope.get() is not None:
+         yield
+         return
+      scope = BatchScope()
+      token = cls._scope.set(scope)
+      failed = False
+      try:
+         yield
+      except BaseException:
+         failed = True
+         raise
+      finally:
+         cls._scope.reset(token)
+         errors = scope.errors
+         pending = list(scope.calls.items())
+         try:
+            for aspect_instance, calls in pending:
+               errors.append(aspect_instance.dispatch(calls))
+         except BaseException as e:
+            # Whatever we didn't get to fails with it too
+            for aspect_instance, calls in pending:
+               fail_calls([call for call in calls if not call.done], e)
+            raise
+         errors = [error for error in errors if error is not None]
+         if errors and not failed:
+            raise errors[0]
+
+class BatchScope(object):
+   '''
+   The calls collected by a batching() block, by aspect instance, and the
+   exceptions from batches that batch_size had dispatched before it ended.
+   '''
+   __slots__ = ("calls", "errors")
+
+   def __init__(self):
+      self.calls = collections.OrderedDict()
+      self.errors = []
+
+class BatchedCall(object):
+   '''
+   One call collected by a BatchingBase aspect.
+   '''
+   __slots__ = ("args", "kwargs", "value", "exception", "done")
+
+   def __init__(self, args, kwargs):
+      self.args = args
+      self.kwargs = kwargs
+      self.value = None
+      self.exception = None
+      self.done = False
+
+   def result(self):
+      if not self.done:
+         raise RuntimeError("the batch this call is in hasn't been "
+                            "dispatched yet")
+      if self.exception is not None:
+         raise self.exception
+      return self.value
+
+def fail_calls(calls, exception):
+   for call in calls:
+      call.exception = exception
+      call.done = True
+
+class WindowBatch(object):
+   def __init__(self):
+      self.calls = []
+      self.dispatched = threading.Event()
 
 # For the next aspect, the scoping trick from DepthBase won't work, so we have
 # to use a metaclass.
 class CoverageMeta(type):
    def __new__(meta, classname, supers, classdict):
       classdict["instances"] = set()
+      classdict["hits"] = set()
       return type.__new__(meta, classname, supers, classdict)
-      
-class CoverageBase(ExecutionBase):
+
+# Python 2 and 3 spell metaclasses differently, but both will take a base class
+# that was made by the metaclass
+class CoverageBase(CoverageMeta("CoverageRoot", (ExecutionBase,), {})):
    '''
    Base class for identifying functions and methods that have not been used.
    A quick and dirty way to focus the programmer's attention on potentially
    orphaned code. This is best used in a REPL-like environment so you can query
-   the `instances` class variable.
+   the `instances` class variable, which holds the registry keys (see
+   weaver.get_key) of the callables that haven't been called yet (`hits`
+   holds the ones that have). Keys stay the same when the weaver swaps in a
+   different core callable, as the code backend does.
+
+   With `unweave_on_hit = True`, an aspect takes itself off each target the
+   first time it is called, so once the code that gets used has warmed up it
+   runs at full speed again, and only the code that is never called keeps the
+   aspect. That makes it cheap enough to leave on in production; report()
+   and export() summarize what hasn't been hit. The hit itself only queues
+   the target, and a background thread does the unweaving shortly after;
+   unweave_hits() does it straight away.
    '''
-   __metaclass__ = CoverageMeta
-   
+   unweave_on_hit = False
+   # Set once this instance's target has been queued for unweaving
+   queued = False
+
+   @classmethod
+   def enable(cls):
+      if cls.unweave_on_hit:
+         start_unweaver()
+      super(CoverageBase, cls).enable()
+
    def __init__(self, next_callable, core_callable):
       super(CoverageBase, self).__init__(next_callable, core_callable)
-      self.__class__.instances.add(self.core_callable)
+      self.key = get_key(core_callable)
+      if self.key not in self.__class__.hits:
+         self.__class__.instances.add(self.key)
+
    def before_advice(self, *args, **kwargs):
-      if self.core_callable in self.__class__.instances:
-         self.__class__.instances.remove(self.core_callable)
+      if self.key in self.__class__.instances:
+         self.__class__.instances.discard(self.key)
+         self.__class__.hits.add(self.key)
+      if self.unweave_on_hit and not self.queued:
+         self.unweave()
+
+   def unweave(self):
+      # Publishing the change here would hold up the call, and it would also
+      # have to wait for whoever else is weaving, so the unweaver thread does
+      # it instead
+      self.queued = True
+      _unweave_queue.append(self)
+      if _unweaver is None:
+         start_unweaver()
+      _unweave_wanted.set()
+
+   @staticmethod
+   def unweave_hits():
+      '''
+      Take coverage aspects off the targets they have been hit on, rather
+      than leaving it to the unweaver thread.
+      '''
+      with weaver.lock:
+         with batch("CoverageBase.unweave_hits"):
+            while _unweave_queue:
+               aspect_instance = _unweave_queue.popleft()
+               core_callable = aspect_instance.core_callable
+               location = weaver.registry.locate(core_callable)
+               # It may have been disabled, or even enabled again, since
+               if (location is not None and
+                   aspect_instance in location.aspects):
+                  uninstall(type(aspect_instance), core_callable)
+
+   @classmethod
+   def coverage_classes(cls):
+      classes = [cls]
+      for subclass in cls.__subclasses__():
+         classes.extend(subclass.coverage_classes())
+      return classes
+
+   @classmethod
+   def report(cls):
+      '''
+      Summarize coverage for this aspect class and its subclasses (so
+      CoverageBase.report() covers every coverage aspect): the dotted names
+      of the callables that haven't been hit, and how many have and haven't.
+      '''
+      unhit = set()
+      hit = set()
+      for class_ in cls.coverage_classes():
+         unhit.update(class_.instances)
+         hit.update(class_.hits)
+      unhit -= hit
+      return {"unhit": sorted(".".join(part for part in key if part)
+                              for key in unhit),
+              "hit_count": len(hit),
+              "unhit_count": len(unhit)}
+
+   @classmethod
+   def export(cls, file):
+      '''
+      Write report() as JSON to file, which may be a path or a file object.
+      '''
+      if hasattr(file, "write"):
+         json.dump(cls.report(), file, indent=1, sort_keys=True)
+      else:
+         with open(file, "w") as output:
+            json.dump(cls.report(), output, indent=1, sort_keys=True)
+
+# Coverage aspects whose targets have been hit, waiting to be unwoven by the
+# unweaver thread, which _unweave_wanted wakes up
+_unweave_queue = collections.deque()
+_unweave_wanted = threading.Event()
+_unweaver_lock = threading.Lock()
+_unweaver = None
+
+def start_unweaver():
+   global _unweaver
+   with _unweaver_lock:
+      if _unweaver is None:
+         _unweaver = threading.Thread(target=run_unweaver,
+                                      name="AOPy unweaver")
+         _unweaver.daemon = True
+         _unweaver.start()
+
+def run_unweaver():
+   while True:
+      _unweave_wanted.wait()
+      _unweave_wanted.clear()
+      CoverageBase.unweave_hits()
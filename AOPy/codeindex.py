@@ -0,0 +1,111 @@
+'''
+Map code objects back to the functions, methods and classes they come from,
+e.g. to turn the code object of a caller found on the stack into something
+more useful. The index is filled in lazily, one module at a time, the first
+time one of its code objects is looked up, and only holds weak references,
+so it never keeps a reloaded module's old functions alive.
+'''
+import sys
+import types
+import weakref
+import collections
+from . import weaver
+from . import pointcuts
+
+# Where a code object comes from: the name of its module, the class it is a
+# method of (None for functions) and the function itself. Code objects of
+# nested functions and lambdas map to the function they are defined in.
+Origin = collections.namedtuple("Origin", "module owner function")
+
+class CodeIndex(object):
+   def __init__(self):
+      # code object -> (module name, weakref to owner or None, weakref to
+      # function), or None for code we couldn't place
+      self.entries = weakref.WeakKeyDictionary()
+      # source file name -> module name, for the modules we know about
+      self.files = {}
+      # How many modules were loaded when files was last brought up to date
+      self.modules_seen = 0
+
+   def entry(self, code):
+      '''
+      The raw entry for code: a tuple whose first item is the module name, or
+      None. This is the fast path for checks that only need the module.
+      '''
+      try:
+         return self.entries[code]
+      except KeyError:
+         pass
+      except TypeError:
+         # Not weakly referenceable, so not a code object
+         return None
+      module = self.module_for(code.co_filename)
+      if module is not None:
+         self.add_module(module)
+      return self.entries.setdefault(code, None)
+
+   def lookup(self, code):
+      '''
+      Find the Origin of code, or None if it doesn't come from a function or
+      method defined at the top level of a module or class.
+      '''
+      entry = self.entry(code)
+      if entry is None:
+         return None
+      module_name, owner_ref, function_ref = entry
+      function = function_ref()
+      owner = None if owner_ref is None else owner_ref()
+      if function is None:
+         return None
+      return Origin(module_name, owner, function)
+
+   def module_for(self, filename):
+      module_name = self.files.get(filename)
+      if module_name is None and len(sys.modules) != self.modules_seen:
+         # Something has been imported since we last looked
+         self.modules_seen = len(sys.modules)
+         self.files.clear()
+         for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if path is not None:
+               if path.endswith((".pyc", ".pyo")):
+                  path = path[:-1]
+               self.files[path] = name
+         module_name = self.files.get(filename)
+      return None if module_name is None else sys.modules.get(module_name)
+
+   def add_module(self, module):
+      '''
+      Index the functions defined in module and the methods of the classes
+      defined there, by their original (unwoven) code.
+      '''
+      for candidate in pointcuts.module_candidates(module):
+         if not candidate.direct:
+            continue
+         function = candidate.callable
+         location = weaver.registry.locate(function)
+         if location is not None:
+            function = location.core_callable
+         function = getattr(function, "__func__", function)
+         if not isinstance(function, types.FunctionType):
+            continue
+         entry = (module.__name__,
+                  None if candidate.owner is None
+                  else weakref.ref(candidate.owner),
+                  weakref.ref(function))
+         self.add_code(function.__code__, entry)
+
+   def add_code(self, code, entry):
+      self.entries[code] = entry
+      for const in code.co_consts:
+         if isinstance(const, types.CodeType):
+            self.add_code(const, entry)
+
+# The index CallBase consults
+index = CodeIndex()
+
+def lookup(code):
+   '''
+   Find the Origin of code; see CodeIndex.lookup.
+   '''
+   return index.lookup(code)
@@ -0,0 +1,96 @@
+'''
+State that is private to the current thread and, on Python 3.7 and up, to the
+current asyncio task.
+'''
+import threading
+
+try:
+   from contextvars import ContextVar
+   per_task = True
+except ImportError:
+   per_task = False
+   # Without contextvars, threads are the only flavor of concurrency we can
+   # tell apart, so fall back to a thread-local with the same interface
+   _missing = object()
+
+   class ContextVar(threading.local):
+      '''
+      Stand-in for contextvars.ContextVar. threading.local runs __init__ again
+      with the same arguments the first time each thread touches the object,
+      so every thread starts out with the default.
+      '''
+      def __init__(self, name, default=_missing):
+         self.name = name
+         if default is not _missing:
+            self.value = default
+
+      def get(self, default=_missing):
+         try:
+            return self.value
+         except AttributeError:
+            if default is _missing:
+               raise LookupError(self)
+            return default
+
+      def set(self, value):
+         # The token is just whatever was there before
+         token = getattr(self, "value", _missing)
+         self.value = value
+         return token
+
+      def reset(self, token):
+         if token is _missing:
+            del self.value
+         else:
+            self.value = token
+
+class ContextStack(object):
+   '''
+   A stack whose contents belong to the current thread or task, for aspects
+   that keep something like a call stack of their own. It supports the parts
+   of the list interface such an aspect usually needs (append, pop, len and
+   indexing).
+
+   The stack is stored as an immutable linked list, so an asyncio task that
+   inherits its parent's context can push and pop without disturbing the
+   parent, and pushing or looking at the top is O(1).
+   '''
+   def __init__(self, name):
+      self._var = ContextVar(name, default=None)
+
+   def append(self, item):
+      node = self._var.get()
+      self._var.set((item, node, 1 if node is None else node[2] + 1))
+
+   push = append
+
+   def pop(self):
+      node = self._var.get()
+      if node is None:
+         raise IndexError("pop from empty stack")
+      self._var.set(node[1])
+      return node[0]
+
+   def __len__(self):
+      node = self._var.get()
+      return 0 if node is None else node[2]
+
+   def __getitem__(self, index):
+      node = self._var.get()
+      length = 0 if node is None else node[2]
+      if index < 0:
+         index += length
+      if not 0 <= index < length:
+         raise IndexError("stack index out of range")
+      for _ in range(length - 1 - index):
+         node = node[1]
+      return node[0]
+
+   def __iter__(self):
+      # Bottom to top, like a list used as a stack
+      items = []
+      node = self._var.get()
+      while node is not None:
+         items.append(node[0])
+         node = node[1]
+      return reversed(items)
@@ -0,0 +1,270 @@
+'''
+Coroutine and async generator versions of the aspect base classes' calling
+semantics. This module needs Python 3.6 or later, so nothing imports it on
+older versions.
+
+Each base class exposes a coroutine_wrapper method (and, where it makes sense,
+an async_generator_wrapper method) that returns a native `async def` function
+running the base's semantics around `await self.next_callable(...)`. The
+weaver installs that function directly in place of the usual wrapper, so the
+advice brackets the awaited execution rather than the creation of the
+coroutine, and there is no extra task or event loop round trip per call.
+'''
+
+def execution_coroutine(self):
+   '''
+   ExecutionBase semantics for coroutine functions.
+   '''
+   async def wrapper(*args, **kwargs):
+      self.before_advice(*args, **kwargs)
+      try:
+         result = await self.next_callable(*args, **kwargs)
+      except Exception as e:
+         self.after_exception_advice(e, *args, **kwargs)
+         raise
+      else:
+         self.after_advice(result, *args, **kwargs)
+      return result
+   return wrapper
+
+def joinpoint_coroutine(self):
+   '''
+   JoinPointBase semantics for coroutine functions.
+   '''
+   from .base import acquire_joinpoint, release_joinpoint
+   async def wrapper(*args, **kwargs):
+      joinpoint = acquire_joinpoint(self.core_callable, args, kwargs)
+      try:
+         self.before_advice(joinpoint)
+         try:
+            result = await self.next_callable(*args, **kwargs)
+         except Exception as e:
+            joinpoint.exception = e
+            self.after_exception_advice(joinpoint)
+            raise
+         else:
+            joinpoint.retval = result
+            self.after_advice(joinpoint)
+         return result
+      finally:
+         release_joinpoint(joinpoint)
+   return wrapper
+
+def depth_coroutine(self):
+   '''
+   DepthBase semantics for coroutine functions. The depth is kept in the
+   current task's context, so concurrently running tasks don't see each
+   other's calls.
+   '''
+   depth = self._depth
+   async def wrapper(*args, **kwargs):
+      self.before_advice(*args, **kwargs)
+      token = depth.set(depth.get() + 1)
+      try:
+         result = await self.next_callable(*args, **kwargs)
+      except Exception as e:
+         depth.reset(token)
+         self.after_exception_advice(e, *args, **kwargs)
+         raise
+      else:
+         depth.reset(token)
+         self.after_advice(result, *args, **kwargs)
+      return result
+   return wrapper
+
+def trace_coroutine(self):
+   '''
+   TraceBase semantics for coroutine functions. The exit record is written
+   when the awaited execution finishes, not when the coroutine is created.
+   '''
+   from .tracing import ENTER, EXIT, EXCEPTION
+   depth = self._depth
+   record = self._record
+   joinpoint = self._joinpoint
+   async def wrapper(*args, **kwargs):
+      level = depth.get()
+      record(ENTER, joinpoint, level)
+      token = depth.set(level + 1)
+      try:
+         result = await self.next_callable(*args, **kwargs)
+      except Exception:
+         depth.reset(token)
+         record(EXCEPTION, joinpoint, level)
+         raise
+      depth.reset(token)
+      record(EXIT, joinpoint, level)
+      return result
+   return wrapper
+
+def cflow_coroutine(self):
+   '''
+   CFlowBase semantics for coroutine functions. Tasks created inside the cflow
+   inherit it, since they start with a copy of the creating task's context.
+   '''
+   within_cflow = self._within_cflow
+   async def wrapper(*args, **kwargs):
+      if within_cflow.get():
+         return await self.next_callable(*args, **kwargs)
+      else:
+         self.before_advice(*args, **kwargs)
+         token = within_cflow.set(True)
+         try:
+            result = await self.next_callable(*args, **kwargs)
+         except Exception as e:
+            within_cflow.reset(token)
+            self.after_exception_advice(e, *args, **kwargs)
+            raise
+         else:
+            within_cflow.reset(token)
+            self.after_advice(result, *args, **kwargs)
+         return result
+   return wrapper
+
+def sampling_coroutine(self):
+   '''
+   SamplingBase semantics for coroutine functions. As with CFlowBase, tasks
+   created inside a sampled call are sampled too.
+   '''
+   sampled = self._sampled
+   async def wrapper(*args, **kwargs):
+      depth = sampled.get()
+      if not depth:
+         self._countdown -= 1
+         if self._countdown > 0 or not self.take_sample():
+            return await self.next_callable(*args, **kwargs)
+      token = sampled.set(depth + 1)
+      try:
+         self.before_advice(*args, **kwargs)
+         try:
+            result = await self.next_callable(*args, **kwargs)
+         except Exception as e:
+            self.after_exception_advice(e, *args, **kwargs)
+            raise
+         else:
+            self.after_advice(result, *args, **kwargs)
+         return result
+      finally:
+         sampled.reset(token)
+   return wrapper
+
+def caching_coroutine(self):
+   '''
+   CachingBase semantics for coroutine functions: the awaited result is what
+   gets cached, since a coroutine object can only be awaited once.
+   '''
+   from .base import sampling_clock
+   async def wrapper(*args, **kwargs):
+      cache, key = self.cache_key(args, kwargs)
+      try:
+         value, expires = cache.pop(key)
+      except KeyError:
+         pass
+      except TypeError:
+         return await self.next_callable(*args, **kwargs)
+      else:
+         if expires is None or expires > sampling_clock():
+            cache[key] = (value, expires)
+            self.hits += 1
+            return value
+         self.evictions += 1
+      self.misses += 1
+      value = await self.next_callable(*args, **kwargs)
+      self.store(cache, key, value)
+      return value
+   return wrapper
+
+def advised_async_generator(self, enter=None, applies=None):
+   '''
+   Build an async generator function that drives the async generator returned
+   by self.next_callable, passing asend/athrow/aclose through to it.
+   before_advice runs when iteration actually starts, after_advice (with a
+   retval of None) when the generator is exhausted and after_exception_advice
+   if it raises.
+
+   The body of an async generator only runs while the consumer is awaiting
+   it, so any context state has to be entered and left around each step
+   rather than held across yields; otherwise it would leak into the consumer.
+   enter, if given, is called before each step and returns a callable that
+   undoes it afterwards. applies, if given, is checked once when iteration
+   starts to decide whether this invocation gets any advice at all.
+   '''
+   async def wrapper(*args, **kwargs):
+      agen = self.next_callable(*args, **kwargs)
+      advised = applies is None or applies()
+      if advised:
+         self.before_advice(*args, **kwargs)
+      value = None
+      exception = None
+      try:
+         while True:
+            leave = enter() if advised and enter is not None else None
+            try:
+               if exception is None:
+                  item = await agen.asend(value)
+               else:
+                  item = await agen.athrow(exception)
+            finally:
+               if leave is not None:
+                  leave()
+            exception = None
+            try:
+               value = yield item
+            except GeneratorExit:
+               await agen.aclose()
+               raise
+            except BaseException as e:
+               exception = e
+      except StopAsyncIteration:
+         if advised:
+            self.after_advice(None, *args, **kwargs)
+      except Exception as e:
+         if advised:
+            self.after_exception_advice(e, *args, **kwargs)
+         raise
+   return wrapper
+
+def execution_async_generator(self):
+   '''
+   ExecutionBase semantics for async generator functions.
+   '''
+   return advised_async_generator(self)
+
+def depth_async_generator(self):
+   '''
+   DepthBase semantics for async generator functions.
+   '''
+   depth = self._depth
+   def enter():
+      token = depth.set(depth.get() + 1)
+      return lambda: depth.reset(token)
+   return advised_async_generator(self, enter=enter)
+
+def trace_async_generator(self):
+   '''
+   TraceBase semantics for async generator functions: each step the generator
+   takes shows up in the trace as a call of its own.
+   '''
+   from .tracing import ENTER, EXIT
+   depth = self._depth
+   record = self._record
+   joinpoint = self._joinpoint
+   def enter():
+      level = depth.get()
+      record(ENTER, joinpoint, level)
+      token = depth.set(level + 1)
+      def leave():
+         depth.reset(token)
+         record(EXIT, joinpoint, level)
+      return leave
+   return advised_async_generator(self, enter=enter)
+
+def cflow_async_generator(self):
+   '''
+   CFlowBase semantics for async generator functions.
+   '''
+   within_cflow = self._within_cflow
+   def enter():
+      token = within_cflow.set(True)
+      return lambda: within_cflow.reset(token)
+   return advised_async_generator(self, enter=enter,
+                                  applies=lambda: not within_cflow.get())
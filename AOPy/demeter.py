@@ -0,0 +1,236 @@
+'''
+Checking that an object-oriented design follows the Law of Demeter, after "A
+Case for Statically Executable Advice: Checking the Law of Demeter with
+AspectJ" [Lieberherr, Lorenz, Hu 2003]. As Wikipedia puts it, "a method m of
+an object O may only invoke the methods of the following kinds of objects":
+
+   O itself
+   m's parameters
+   Any objects created/instantiated within m
+   O's direct component objects
+   A global variable, accessible by O, in the scope of m
+
+to which we add one condition specific to Python: members of collections that
+are direct component objects of O. In Python we tend to treat the contents of
+a list attribute as casually as the attribute itself.
+
+The checker keeps a frame for each advised call in progress with the ids of
+its friends. The arguments and created objects go in as they appear, and are
+looked up in a set. O's attributes are compared with the called object
+directly, which costs as much as O has attributes. Only if none of them is
+the called object are O's collections indexed, one at a time, each the first
+time a call from the frame gets that far, and again if it has been replaced,
+grown or shrunk since; the module's globals are listed the first time they
+are needed too. So a method that only calls its own components never looks
+inside O's collections, and one that calls the members of a collection pays
+for indexing it once per call of the method, not once per member. The first
+call from a frame that fails every check is looked at again against freshly
+indexed collections and globals before it is counted as a violation, in case
+they changed in ways their length doesn't show; later ones are checked
+against what was indexed then. The frame holds on to every object whose id
+it keeps, so no id can be reused by another object while the call is in
+progress.
+'''
+import collections
+from .base import AspectBase
+from .registry import get_key
+from .context import ContextStack
+
+# Why a call was acceptable; see LawOfDemeterChecker.checked
+TOP_LEVEL = "called at top level"
+SELF = "is previous self arg"
+ARGUMENT = "passed as argument to previous method"
+CREATED = "created within previous method"
+COMPONENT = "is attribute of previous caller"
+MEMBER = "is member of iterable attribute of previous caller"
+GLOBAL = "is global in the previous method's module"
+INIT = "init method"
+
+# Attributes whose contents count as components too. Other iterables are left
+# alone, since iterating over them could have side effects (or never end).
+COLLECTIONS = (list, tuple, set, frozenset, collections.deque)
+
+class Frame(object):
+   '''
+   What the checker knows about one advised call in progress.
+   '''
+   __slots__ = ("obj", "method", "arguments", "created", "members",
+                "globals_", "global_ids", "global_values", "checks",
+                "globals_checked", "regathered")
+
+   def __init__(self, obj, method, arguments, globals_):
+      self.obj = obj
+      self.method = method
+      # ids of the arguments (which the call holds on to), and the objects
+      # created so far by id
+      self.arguments = arguments
+      self.created = {}
+      # For each of obj's collection attributes that some call has needed,
+      # the collection, its length then, its members, their ids and the check
+      # it was indexed for
+      self.members = {}
+      self.globals_ = globals_
+      self.global_ids = None
+      self.global_values = None
+      # Which check this is, and the one the globals were listed in, so that
+      # what a check gathered isn't gathered again when it misses
+      self.checks = 0
+      self.globals_checked = None
+      # Whether a miss has had us gather everything again yet
+      self.regathered = False
+
+   def index_members(self, name, value):
+      if isinstance(value, dict):
+         members = list(value.keys()) + list(value.values())
+      else:
+         members = list(value)
+      self.members[name] = (value, len(value), members,
+                            set(map(id, members)), self.checks)
+
+   def gather_globals(self):
+      if self.globals_ is None:
+         self.global_values = []
+      else:
+         self.global_values = list(self.globals_.values())
+      self.global_ids = set(map(id, self.global_values))
+      self.globals_checked = self.checks
+
+Violation = collections.namedtuple("Violation",
+                                   "method called_from object_type")
+
+class LawOfDemeterChecker(AspectBase):
+   '''
+   Base class for aspects that check calls to their targets against the Law
+   of Demeter; set targets to the methods of the classes being checked. Each
+   call is checked against the frame of the advised call it was made from,
+   and violations are counted in a report (see report()) rather than
+   printed. Calls to __init__ methods are always acceptable, and an object
+   only counts as created within a method if its class's __init__ is one of
+   the targets.
+
+   checked(obj, method, reason) is called for every check, with one of the
+   reasons defined in this module, or None for a violation; it does nothing
+   by default, but a subclass can use it to print a running commentary.
+   '''
+   __slots__ = ("name", "is_init", "globals_")
+
+   # Same trick as in DepthBase: each concrete checker class gets a stack of
+   # frames and a report of its own
+   def __new__(cls, *args, **kwargs):
+      if "_frames" not in vars(cls):
+         cls._frames = ContextStack(cls.__name__ + ".frames")
+         cls._violations = collections.OrderedDict()
+      return super(LawOfDemeterChecker, cls).__new__(cls)
+
+   def __init__(self, next_callable, core_callable):
+      super(LawOfDemeterChecker, self).__init__(next_callable, core_callable)
+      self.name = ".".join(part for part in get_key(core_callable) if part)
+      self.is_init = core_callable.__name__ == "__init__"
+      function = getattr(core_callable, "__func__", core_callable)
+      self.globals_ = getattr(function, "__globals__", None)
+
+   def __call__(self, *args, **kwargs):
+      frames = self._frames
+      obj = args[0] if args else None
+      if len(frames):
+         self.check(frames[-1], obj)
+      else:
+         self.checked(obj, self.name, TOP_LEVEL)
+      arguments = set(map(id, args[1:]))
+      if kwargs:
+         arguments.update(map(id, kwargs.values()))
+      frames.append(Frame(obj, self.name, arguments, self.globals_))
+      try:
+         result = self.next_callable(*args, **kwargs)
+      finally:
+         frames.pop()
+         if self.is_init and len(frames):
+            # Objects created within a method are its friends from now on.
+            # Even a failed __init__ leaves an object behind.
+            frames[-1].created[id(obj)] = obj
+      return result
+
+   def check(self, frame, obj):
+      frame.checks += 1
+      reason = self.reason(frame, obj, False)
+      if reason is None and not self.is_init and not frame.regathered:
+         # Before calling it a violation, make sure it isn't just that the
+         # previous caller or its module changed since we last looked. Only
+         # what was gathered for an earlier check is gathered again, and
+         # since that costs as much as O's collections are big, only once
+         # per frame.
+         frame.regathered = True
+         reason = self.reason(frame, obj, True)
+      if reason is None and self.is_init:
+         reason = INIT
+      if reason is None:
+         violation = Violation(self.name, frame.method,
+                               "%s.%s" % (type(obj).__module__,
+                                          type(obj).__name__))
+         violations = self._violations
+         violations[violation] = violations.get(violation, 0) + 1
+      self.checked(obj, self.name, reason)
+      return reason
+
+   def reason(self, frame, obj, regather):
+      key = id(obj)
+      if obj is frame.obj:
+         return SELF
+      if key in frame.arguments:
+         return ARGUMENT
+      if key in frame.created:
+         return CREATED
+      values = getattr(frame.obj, "__dict__", None)
+      if values is not None:
+         # O's attributes are compared as they are now, with no index to
+         # keep up to date
+         attributes = list(values.items())
+         for name, value in attributes:
+            if value is obj:
+               return COMPONENT
+         # Only then are its collections indexed, each one the first time
+         # a call gets this far, and again if it was replaced or has grown or
+         # shrunk since
+         for name, value in attributes:
+            if not isinstance(value, COLLECTIONS + (dict,)):
+               continue
+            indexed = frame.members.get(name)
+            if (indexed is None or indexed[0] is not value
+                or indexed[1] != len(value)
+                or regather and indexed[4] != frame.checks):
+               frame.index_members(name, value)
+               indexed = frame.members[name]
+            if key in indexed[3]:
+               return MEMBER
+      if (frame.global_ids is None
+          or regather and frame.globals_checked != frame.checks):
+         frame.gather_globals()
+      if key in frame.global_ids:
+         return GLOBAL
+      return None
+
+   def checked(self, obj, method, reason):
+      pass
+
+   @property
+   def depth(self):
+      '''
+      How many advised calls are in progress around the current one.
+      '''
+      return len(self._frames)
+
+   @classmethod
+   def report(cls):
+      '''
+      The violations seen so far, most frequent first: dicts with the method
+      called, the method it was called from, the type of the object it was
+      called on, and how many times that happened.
+      '''
+      violations = list(vars(cls).get("_violations", {}).items())
+      violations.sort(key=lambda item: -item[1])
+      return [dict(violation._asdict(), count=count)
+              for violation, count in violations]
+
+   @classmethod
+   def reset(cls):
+      vars(cls).get("_violations", {}).clear()
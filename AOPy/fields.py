@@ -0,0 +1,188 @@
+'''
+Join points for reading and assigning attributes, after AspectJ's get() and
+set() pointcuts:
+
+   class ObserverAspect(CFlowBase):
+      targets = fields.writes(Point, "x", "y")
+
+reads(class_, *names) and writes(class_, *names) return targets that can go
+in any aspect's targets like functions and methods do, and the advice is the
+same as for a call: a read is a call with the instance as its only argument,
+returning the value, and a write is a call with the instance and the new
+value, returning None. Reads and writes nested in an advised call count as
+being in its cflow, so a CFlowBase aspect on Point.move_by and on writes to
+Point.x only hears about the writes that aren't part of a move.
+
+Each attribute gets a data descriptor, which the weaver gives the chains for
+reads and writes to call. It only sits on the class while some aspect is
+woven there, and it stores values where Python would (the instance's __dict__
+or its slot), so the class goes back to native attribute access once the
+last aspect is disabled. Attributes nobody targets are never touched, unlike
+with a __setattr__ override.
+'''
+from . import weaver
+
+# The class attribute under which each class keeps its FieldDescriptors, so
+# that the weaver can find them by key even when they aren't on the class
+FIELDS = "__AOPy_fields__"
+
+MISSING = object()
+
+def reads(class_, *names):
+   '''
+   The join points for reading each of the named attributes of class_'s
+   instances.
+   '''
+   return [field(class_, name).native_get for name in names]
+
+def writes(class_, *names):
+   '''
+   The join points for assigning each of the named attributes of class_'s
+   instances.
+   '''
+   return [field(class_, name).native_set for name in names]
+
+def accesses(class_, *names):
+   '''
+   The join points for both reading and assigning each of the named
+   attributes.
+   '''
+   return reads(class_, *names) + writes(class_, *names)
+
+def field(class_, name):
+   '''
+   Get the FieldDescriptor for the named attribute of class_'s instances,
+   making it the first time.
+   '''
+   with weaver.lock:
+      fields = vars(class_).get(FIELDS)
+      if fields is None:
+         fields = Fields()
+         setattr(class_, FIELDS, fields)
+      descriptor = vars(fields).get(name)
+      if descriptor is None:
+         descriptor = FieldDescriptor(class_, name)
+         setattr(fields, name, descriptor)
+      return descriptor
+
+class Fields(object):
+   '''
+   The FieldDescriptors made for a class, as attributes named after the
+   attributes they are for.
+   '''
+
+class FieldDescriptor(object):
+   '''
+   A data descriptor standing in for one attribute of a class's instances.
+   get and set are the callables that reads and writes go through: the
+   native ones, which access the attribute as if the descriptor weren't
+   there, or whatever the weaver has woven around them. The descriptor puts
+   itself on the class when either of them is woven, and takes itself off
+   again, putting back whatever was there before, when neither is.
+   '''
+   # The weaver sets get and set on us even under the code backend, since
+   # swapping the native functions' code would leave us on the class for good
+   woven_by_attribute = True
+
+   def __init__(self, class_, name):
+      self.class_ = class_
+      self.name = name
+      self.own = vars(class_).get(name, MISSING)
+      # get_key finds our way back here from the native functions' names
+      path = "%s.%s.%s" % (getattr(class_, "__qualname__", class_.__name__),
+                           FIELDS, name)
+      functions = native_access(class_, name)
+      for function, suffix in zip(functions, ("get", "set", "delete")):
+         function.__name__ = suffix
+         function.__qualname__ = "%s.%s" % (path, suffix)
+         function.__module__ = class_.__module__
+      self.native_get, self.native_set, self.native_delete = functions
+      self.get = self.native_get
+      self.set = self.native_set
+
+   def __setattr__(self, name, value):
+      object.__setattr__(self, name, value)
+      if name in ("get", "set") and "set" in vars(self):
+         self.place()
+
+   def place(self):
+      woven = (self.get is not self.native_get or
+               self.set is not self.native_set)
+      placed = vars(self.class_).get(self.name) is self
+      if woven and not placed:
+         setattr(self.class_, self.name, self)
+      elif placed and not woven:
+         if self.own is MISSING:
+            delattr(self.class_, self.name)
+         else:
+            setattr(self.class_, self.name, self.own)
+
+   def __get__(self, obj, type_=None):
+      if obj is None:
+         return self
+      return self.get(obj)
+
+   def __set__(self, obj, value):
+      self.set(obj, value)
+
+   def __delete__(self, obj):
+      self.native_delete(obj)
+
+   def __repr__(self):
+      return "<FieldDescriptor %s.%s>" % (self.class_.__name__, self.name)
+
+# Advice looking for its caller should see the code making the access, not us
+weaver.add_chain_code(FieldDescriptor.__get__)
+weaver.add_chain_code(FieldDescriptor.__set__)
+
+def native_access(class_, name):
+   '''
+   Make functions that get, set and delete the named attribute of an instance
+   of class_ the way Python would without a FieldDescriptor in the way: through
+   whatever data descriptor class_ has for it (a slot, say, or a property),
+   and otherwise in the instance's __dict__, falling back to class_'s own
+   attribute on reads.
+   '''
+   original = MISSING
+   for base in class_.__mro__:
+      if name in vars(base):
+         original = vars(base)[name]
+         break
+   kind = type(original)
+   if hasattr(kind, "__set__") and hasattr(kind, "__get__"):
+      get, set_, delete = original.__get__, original.__set__, None
+      if hasattr(kind, "__delete__"):
+         delete = original.__delete__
+      def read(obj):
+         return get(obj, type(obj))
+      def write(obj, value):
+         set_(obj, value)
+      def remove(obj):
+         if delete is None:
+            raise AttributeError("can't delete attribute %r" % (name,))
+         delete(obj)
+      return read, write, remove
+   if not getattr(class_, "__dictoffset__", 1):
+      raise ValueError("%s instances have no slot or __dict__ for %r"
+                       % (class_.__name__, name))
+   def missing(obj):
+      return AttributeError("%r object has no attribute %r"
+                            % (type(obj).__name__, name))
+   def read(obj):
+      try:
+         return obj.__dict__[name]
+      except KeyError:
+         pass
+      if original is MISSING:
+         raise missing(obj)
+      if hasattr(kind, "__get__"):
+         return original.__get__(obj, type(obj))
+      return original
+   def write(obj, value):
+      obj.__dict__[name] = value
+   def remove(obj):
+      try:
+         del obj.__dict__[name]
+      except KeyError:
+         raise missing(obj)
+   return read, write, remove
@@ -0,0 +1,192 @@
+'''
+Weaving at import time. Instead of importing every module an aspect might
+apply to up front, register the aspect here and each module its pointcut
+covers is woven right after it is first imported:
+
+   from AOPy import importhook
+   importhook.register(TraceAspect)
+
+The aspect's targets have to be a pointcut from AOPy.pointcuts, since a list
+of targets can't be written down before the modules holding them are loaded.
+Modules that were imported before registration are woven immediately, and
+modules nobody imports are never touched, so start-up time only depends on
+what actually gets imported.
+
+The finder only sits in sys.meta_path while something is registered, and only
+steps in for modules some registered pointcut covers; everything else is left
+to the normal import machinery.
+'''
+import sys
+import threading
+from . import weaver
+from . import pointcuts
+
+# Registered aspects, in registration order, which is the order they are
+# layered in on each module
+registrations = []
+
+def register(*aspects):
+   '''
+   Weave aspects into every module their pointcuts cover, both the ones that
+   are already imported and the ones that will be.
+   '''
+   for Aspect in aspects:
+      if not isinstance(Aspect.targets, pointcuts.Pointcut):
+         raise TypeError("%s.targets has to be a pointcut to be woven on "
+                         "import" % Aspect.__name__)
+      if Aspect.targets.scope() is None:
+         raise ValueError("%r isn't limited to any modules; combine it with "
+                          "within()" % (Aspect.targets,))
+   with weaver.lock:
+      with weaver.batch("importhook.register"):
+         for Aspect in aspects:
+            if Aspect in registrations:
+               continue
+            registrations.append(Aspect)
+            for name, module in list(sys.modules.items()):
+               if module is not None and Aspect.targets.covers(name):
+                  for target in Aspect.targets.resolve_in(module):
+                     weaver.install(Aspect, target)
+      activate()
+
+def unregister(*aspects):
+   '''
+   Stop weaving aspects into newly imported modules and unwrap them from
+   everything they were woven into.
+   '''
+   with weaver.lock:
+      with weaver.batch("importhook.unregister"):
+         for Aspect in aspects:
+            if Aspect in registrations:
+               registrations.remove(Aspect)
+            for location in weaver.registry.locations_of(Aspect):
+               weaver.uninstall(Aspect, location.core_callable)
+      if not registrations:
+         deactivate()
+
+def weave_module(module):
+   '''
+   Wrap every registered aspect whose pointcut covers module around the
+   functions and methods it matches there. This is what the loader runs after
+   executing a module, and it can also be called by hand.
+
+   If the module has been woven before, it has just been reloaded, and
+   weaver.refresh works out what changed so only that is re-woven.
+   '''
+   name = module.__name__
+   with weaver.lock:
+      weaver.refresh(module, [Aspect for Aspect in registrations
+                              if Aspect.targets.covers(name)])
+
+def covered(fullname):
+   return any(Aspect.targets.covers(fullname) for Aspect in registrations)
+
+class WeavingLoader(object):
+   '''
+   Wraps the loader the rest of the import system found for a module, and
+   weaves the module once the real loader has executed it. Anything else the
+   import system or a tool asks the loader for is passed straight through.
+   '''
+   def __init__(self, loader):
+      self.loader = loader
+
+   def create_module(self, spec):
+      create_module = getattr(self.loader, "create_module", None)
+      return None if create_module is None else create_module(spec)
+
+   def exec_module(self, module):
+      self.loader.exec_module(module)
+      weave_module(module)
+
+   def __getattr__(self, name):
+      return getattr(self.loader, name)
+
+class WeavingFinder(object):
+   '''
+   Meta path finder that asks the finders after it where a covered module
+   comes from and hands back their answer with a WeavingLoader in it.
+   '''
+   def __init__(self):
+      # Names this thread is importing through the legacy protocol, so we
+      # step aside when the normal import machinery looks for them again
+      self.importing = threading.local()
+
+   def find_spec(self, fullname, path=None, target=None):
+      if not covered(fullname):
+         return None
+      for finder in sys.meta_path:
+         if finder is self:
+            continue
+         find_spec = getattr(finder, "find_spec", None)
+         if find_spec is None:
+            continue
+         spec = find_spec(fullname, path, target)
+         if spec is not None:
+            if (spec.loader is not None and
+                hasattr(spec.loader, "exec_module") and
+                not isinstance(spec.loader, WeavingLoader)):
+               spec.loader = WeavingLoader(spec.loader)
+            return spec
+      return None
+
+   # Python 2 has no specs, and its default importers aren't in sys.meta_path
+   # at all, so the finder answers for the module itself and then gets out of
+   # the way while the normal import runs
+
+   def find_module(self, fullname, path=None):
+      if fullname in getattr(self.importing, "names", ()):
+         return None
+      if not covered(fullname):
+         return None
+      return self
+
+   def load_module(self, fullname):
+      names = getattr(self.importing, "names", None)
+      if names is None:
+         names = self.importing.names = set()
+      names.add(fullname)
+      try:
+         module = sys.modules.get(fullname)
+         if module is None:
+            __import__(fullname)
+         else:
+            # This is a reload, which is already underway, so reload() itself
+            # would just hand the module back; execute it again by hand
+            import imp
+            package, _, name = fullname.rpartition(".")
+            path = sys.modules[package].__path__ if package else None
+            found = imp.find_module(name, path)
+            try:
+               imp.load_module(fullname, *found)
+            finally:
+               if found[0] is not None:
+                  found[0].close()
+      finally:
+         names.discard(fullname)
+      module = sys.modules[fullname]
+      weave_module(module)
+      return module
+
+# The finder, once activate has put it in sys.meta_path
+finder = None
+
+def activate():
+   '''
+   Put the finder at the front of sys.meta_path. register does this, so it is
+   only needed after an explicit deactivate.
+   '''
+   global finder
+   with weaver.lock:
+      if finder is None:
+         finder = WeavingFinder()
+      if finder not in sys.meta_path:
+         sys.meta_path.insert(0, finder)
+
+def deactivate():
+   '''
+   Take the finder out of sys.meta_path. Modules imported afterwards aren't
+   woven, but what has already been woven stays that way.
+   '''
+   with weaver.lock:
+      if finder is not None and finder in sys.meta_path:
+         sys.meta_path.remove(finder)
@@ -0,0 +1,245 @@
+'''
+Measure how much AOPy itself costs. While instrumentation is on, every chain
+is rebuilt with a timer around each layer, around each piece of advice and
+around the core callable, so the time a call spends at a location can be
+split into
+
+   core: the core callable itself
+   advice: each aspect's before/after/after_exception advice
+   dispatch: everything else in each aspect's layer, i.e. its __call__ and
+             the wrapper around it
+
+and the weaver records how long each batch (enable, disable, ...) and each
+unbatched update_wrappings takes. Turning instrumentation off rebuilds the
+chains without the timers, so it costs nothing at all when it isn't on.
+
+   from AOPy import instrumentation
+   instrumentation.enable()
+   ...
+   stats = instrumentation.snapshot()
+
+Timed chains are always layered, whatever the chain mode, and only plain
+functions are timed; coroutines and async generators keep their usual chains,
+since their time spent suspended would be counted too. So do locations with
+a stateless aspect, whose one instance can't be timed separately for each
+of its targets, and the advice of aspects whose instances have no __dict__
+isn't timed apart from their layer.
+'''
+import time
+import functools
+from . import weaver
+
+# The best clock we have for measuring short intervals
+clock = getattr(time, "perf_counter", time.time)
+
+# The recorder holding the counters, which is kept while instrumentation is
+# off so the numbers can still be looked at
+recorder = None
+
+def timed(callable_, counter):
+   '''
+   Wrap callable_ so that each call adds one to counter[0] and the time it
+   took to counter[1].
+   '''
+   @functools.wraps(callable_)
+   def wrapper(*args, **kwargs):
+      start = clock()
+      try:
+         return callable_(*args, **kwargs)
+      finally:
+         counter[0] += 1
+         counter[1] += clock() - start
+   weaver.add_chain_code(wrapper)
+   return wrapper
+
+def calibrate(number=2000):
+   '''
+   Estimate how much time a timed wrapper adds to the measurement of whatever
+   is around it, which is then subtracted from the dispatch times.
+   '''
+   def noop():
+      pass
+   inner = [0, 0.0]
+   outer = [0, 0.0]
+   callable_ = timed(timed(noop, inner), outer)
+   for _ in range(number):
+      callable_()
+   return max(0.0, (outer[1] - inner[1]) / number)
+
+class LocationStats(object):
+   '''
+   Counters for one location: the core callable's [calls, seconds], and for
+   each aspect class that has been wrapped there, the layer's [calls, seconds]
+   and its advice's [calls, seconds]. order lists the aspect classes
+   innermost first, as of the last time the chain was built.
+   '''
+   def __init__(self, name):
+      self.name = name
+      self.core = [0, 0.0]
+      self.layers = {}
+      self.advice = {}
+      self.order = []
+
+class Recorder(object):
+   '''
+   Builds timed chains for the weaver and keeps the counters they update.
+   '''
+   clock = staticmethod(clock)
+
+   def __init__(self):
+      self.locations = {}
+      self.weaving = {}
+      self.overhead = calibrate()
+
+   def stats_for(self, location):
+      stats = self.locations.get(location.key)
+      if stats is None:
+         stats = self.locations[location.key] = LocationStats(
+            ".".join(part for part in location.key if part))
+      return stats
+
+   def build_wrappings(self, location, kind, links):
+      '''
+      Build a timed chain for location, or return None to leave it to the
+      weaver.
+      '''
+      if kind != "function" or any(weaver.is_shared(aspect_instance)
+                                   for aspect_instance in location.aspects):
+         return None
+      stats = self.stats_for(location)
+      stats.order = [type(aspect_instance)
+                     for aspect_instance in location.aspects]
+      callable_ = timed(location.core_callable, stats.core)
+      for aspect_instance in location.aspects:
+         Aspect = type(aspect_instance)
+         layer = stats.layers.setdefault(Aspect, [0, 0.0])
+         advice = stats.advice.setdefault(Aspect, [0, 0.0])
+         # Instance attributes shadow the advice methods, so the aspect's
+         # __call__ runs the timed versions without knowing
+         if hasattr(aspect_instance, "__dict__"):
+            remove_shims(aspect_instance)
+            for name, method in zip(weaver.ADVICE_NAMES,
+                                    weaver.overridden_advice(aspect_instance)):
+               if method is not None:
+                  setattr(aspect_instance, name, timed(method, advice))
+         callable_ = timed(weaver.wrap_aspect(aspect_instance, callable_, kind,
+                                              links),
+                           layer)
+      return callable_
+
+   def record_weaving(self, label, seconds, locations):
+      counters = self.weaving.get(label)
+      if counters is None:
+         counters = self.weaving[label] = {"count": 0, "seconds": 0.0,
+                                           "max_seconds": 0.0, "locations": 0}
+      counters["count"] += 1
+      counters["seconds"] += seconds
+      counters["max_seconds"] = max(counters["max_seconds"], seconds)
+      counters["locations"] += locations
+
+   def snapshot(self):
+      '''
+      Summarize the counters as plain dicts; see the module level snapshot.
+      '''
+      locations = {}
+      aspects = {}
+      for stats in list(self.locations.values()):
+         inner_seconds = stats.core[1]
+         layers = []
+         for Aspect in stats.order:
+            calls, seconds = stats.layers[Aspect]
+            advice_calls, advice_seconds = stats.advice[Aspect]
+            dispatch_seconds = max(0.0, seconds - inner_seconds -
+                                   advice_seconds -
+                                   self.overhead * (calls + advice_calls))
+            layers.append({"aspect": Aspect.__name__,
+                           "calls": calls,
+                           "seconds": seconds,
+                           "advice_seconds": advice_seconds,
+                           "dispatch_seconds": dispatch_seconds})
+            totals = aspects.setdefault(Aspect.__name__,
+                                        {"calls": 0, "advice_seconds": 0.0,
+                                         "dispatch_seconds": 0.0})
+            totals["calls"] += calls
+            totals["advice_seconds"] += advice_seconds
+            totals["dispatch_seconds"] += dispatch_seconds
+            inner_seconds = seconds
+         aop_seconds = sum(layer["advice_seconds"] + layer["dispatch_seconds"]
+                           for layer in layers)
+         locations[stats.name] = {"calls": stats.core[0],
+                                  "core_seconds": stats.core[1],
+                                  "aop_seconds": aop_seconds,
+                                  "layers": layers}
+      return {"locations": locations,
+              "aspects": aspects,
+              "weaving": dict((label, dict(counters))
+                              for label, counters in self.weaving.items())}
+
+def remove_shims(aspect_instance):
+   for name in weaver.ADVICE_NAMES:
+      getattr(aspect_instance, "__dict__", {}).pop(name, None)
+
+def rebuild(label):
+   with weaver.batch(label):
+      for location in weaver.registry:
+         if weaver.recorder is None:
+            for aspect_instance in location.aspects:
+               remove_shims(aspect_instance)
+         weaver.update_wrappings(location)
+
+def enable():
+   '''
+   Start timing: rebuild every woven chain with timers in it. Counters
+   collected before a previous disable are kept.
+   '''
+   global recorder
+   with weaver.lock:
+      if weaver.recorder is None:
+         if recorder is None:
+            recorder = Recorder()
+         weaver.recorder = recorder
+         rebuild("instrumentation.enable")
+
+def disable():
+   '''
+   Stop timing: rebuild every woven chain without timers.
+   '''
+   with weaver.lock:
+      if weaver.recorder is not None:
+         weaver.recorder = None
+         rebuild("instrumentation.disable")
+
+def is_enabled():
+   return weaver.recorder is not None
+
+def reset():
+   '''
+   Zero all the counters.
+   '''
+   global recorder
+   with weaver.lock:
+      recorder = Recorder()
+      if weaver.recorder is not None:
+         # The timed chains hold on to the old counters
+         weaver.recorder = recorder
+         rebuild("instrumentation.reset")
+
+def snapshot():
+   '''
+   Get everything measured so far as a dict:
+
+   "locations": for each woven callable (by dotted name), the number of
+      "calls", "core_seconds" spent in the core callable, "aop_seconds"
+      spent in AOPy and the aspects, and "layers", innermost first, each
+      with the "aspect" name, its "calls", the total "seconds" spent in the
+      layer (including everything inside it), and how much of that was
+      "advice_seconds" and "dispatch_seconds"
+   "aspects": the calls, advice_seconds and dispatch_seconds of each aspect
+      class added up over all locations
+   "weaving": for each batch label (e.g. "TraceAspect.enable") and for
+      "update_wrappings" outside of batches, the "count", total "seconds",
+      "max_seconds" and number of "locations" rebuilt
+   '''
+   if recorder is None:
+      return {"locations": {}, "aspects": {}, "weaving": {}}
+   return recorder.snapshot()
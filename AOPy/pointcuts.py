@@ -0,0 +1,377 @@
+'''
+Declarative pointcuts: composable descriptions of a set of targets that are
+only worked out when an aspect is enabled, so defining an aspect doesn't have
+to import and scan every module it might apply to.
+
+A pointcut can be used as an aspect's `targets` in place of a list:
+
+   class ObserverAspect(CFlowBase):
+      targets = (within("shapes")
+                 & subclass_of("shapes.Shape")
+                 & named("move*", "set*"))
+
+Pointcuts combine with & (and), | (or) and ~ (not). Every pointcut has to be
+limited to some modules with within(); everything else just filters the
+functions and methods found in those modules.
+'''
+import sys
+import types
+import fnmatch
+import importlib
+import collections
+from .registry import get_key
+
+# A function or method that a pointcut may pick out. owner is None for module
+# level functions, and direct tells whether a method is defined on owner itself
+# rather than inherited from one of its bases. Weaving an inherited method
+# weaves it for the base that defines it and every other class inheriting it,
+# so origin is the same method as seen from that base (with direct still
+# False), which the pointcut has to match too; it is None for direct ones.
+Candidate = collections.namedtuple("Candidate",
+                                   "module owner name callable direct origin")
+
+# Candidates found in each module, by module name, along with the module object
+# they were found in
+_candidates = {}
+
+def module_candidates(module):
+   '''
+   List the functions defined in module and the methods of the classes defined
+   there. The result is cached until invalidate is called for the module.
+   '''
+   cached = _candidates.get(module.__name__)
+   if cached is not None and cached[0] is module:
+      return cached[1]
+   found = []
+   for name, value in sorted(vars(module).items()):
+      if getattr(value, "__module__", None) != module.__name__:
+         # Imported from somewhere else
+         continue
+      if isinstance(value, types.FunctionType):
+         found.append(Candidate(module, None, name, value, True, None))
+      elif isinstance(value, type):
+         found.extend(class_candidates(module, value))
+   _candidates[module.__name__] = (module, found)
+   return found
+
+def class_candidates(module, class_):
+   for name in sorted(dir(class_)):
+      # Only plain functions make sense as targets; static and class methods
+      # would stop working if they were replaced by a wrapper function
+      for defining_class in class_.__mro__:
+         if name in vars(defining_class):
+            if isinstance(vars(defining_class)[name], types.FunctionType):
+               callable_ = getattr(class_, name)
+               origin = None
+               if defining_class is not class_:
+                  origin = Candidate(
+                     sys.modules.get(defining_class.__module__),
+                     defining_class, name, callable_, False, None)
+               yield Candidate(module, class_, name, callable_,
+                               origin is None, origin)
+            break
+
+def invalidate(module_name=None):
+   '''
+   Forget the cached candidates for a module, or for every module.
+   '''
+   if module_name is None:
+      _candidates.clear()
+   else:
+      _candidates.pop(module_name, None)
+
+def resolve_class(class_):
+   '''
+   Classes can be named by dotted path so that the module defining them isn't
+   imported until the pointcut is resolved.
+   '''
+   if isinstance(class_, str):
+      module_name, _, name = class_.rpartition(".")
+      return getattr(importlib.import_module(module_name), name)
+   return class_
+
+class Pointcut(object):
+   '''
+   Base class for pointcuts. Subclasses implement matches, and scope if they
+   limit which modules need to be searched. Anything matches needs that only
+   changes between resolutions (such as classes named by dotted path) is
+   worked out in prepare, which is called before a module's candidates are
+   matched.
+   '''
+   def matches(self, candidate):
+      raise NotImplementedError
+
+   def prepare(self):
+      pass
+
+   def extra_candidates(self, module):
+      '''
+      Candidates in module that scanning it doesn't find, such as the join
+      points fields.writes() makes, if this pointcut names them.
+      '''
+      return []
+
+   def scope(self):
+      '''
+      The module name patterns that every match must come from, or None if
+      this pointcut doesn't restrict modules.
+      '''
+      return None
+
+   def covers(self, module_name):
+      '''
+      Whether module_name is one of the modules this pointcut searches.
+      '''
+      patterns = self.scope()
+      if patterns is None:
+         raise ValueError("%r isn't limited to any modules; combine it with "
+                          "within()" % (self,))
+      return any(fnmatch.fnmatchcase(module_name, pattern)
+                 for pattern in patterns)
+
+   def modules(self):
+      patterns = self.scope()
+      if patterns is None:
+         raise ValueError("%r isn't limited to any modules; combine it with "
+                          "within()" % (self,))
+      modules = set()
+      for pattern in patterns:
+         if any(char in pattern for char in "*?["):
+            # Globs can only match modules that have already been imported
+            modules.update(module for name, module in list(sys.modules.items())
+                           if module is not None
+                           and fnmatch.fnmatchcase(name, pattern))
+         else:
+            modules.add(importlib.import_module(pattern))
+      return sorted(modules, key=lambda module: module.__name__)
+
+   def resolve(self):
+      '''
+      Find every function and method this pointcut matches right now.
+      '''
+      targets = []
+      seen = set()
+      for module in self.modules():
+         for target in self.resolve_in(module):
+            if id(target) not in seen:
+               seen.add(id(target))
+               targets.append(target)
+      return targets
+
+   def resolve_in(self, module):
+      '''
+      Find the functions and methods in module this pointcut matches.
+      '''
+      self.prepare()
+      candidates = module_candidates(module)
+      extra = self.extra_candidates(module)
+      if extra:
+         candidates = candidates + extra
+      return [candidate.callable for candidate in candidates
+              if self.matches(candidate) and
+              (candidate.origin is None or
+               (candidate.origin.module is not None and
+                self.matches(candidate.origin)))]
+
+   def __iter__(self):
+      # Lets a pointcut stand in for a list of targets
+      return iter(self.resolve())
+
+   def __and__(self, other):
+      return And(self, other)
+
+   def __or__(self, other):
+      return Or(self, other)
+
+   def __invert__(self):
+      return Not(self)
+
+class within(Pointcut):
+   '''
+   Functions and methods defined in modules whose names match any of the
+   given glob patterns. Patterns without wildcards are imported when the
+   pointcut is resolved; globs only match modules that are already imported.
+   '''
+   def __init__(self, *patterns):
+      self.patterns = patterns
+
+   def scope(self):
+      return set(self.patterns)
+
+   def matches(self, candidate):
+      return any(fnmatch.fnmatchcase(candidate.module.__name__, pattern)
+                 for pattern in self.patterns)
+
+   def __repr__(self):
+      return "within(%s)" % ", ".join(map(repr, self.patterns))
+
+class subclass_of(Pointcut):
+   '''
+   Methods of subclasses of any of the given classes (including the classes
+   themselves). Classes may be given as dotted paths.
+   '''
+   def __init__(self, *classes):
+      self.classes = classes
+      self.resolved = None
+
+   def prepare(self):
+      self.resolved = tuple(resolve_class(class_) for class_ in self.classes)
+
+   def matches(self, candidate):
+      if self.resolved is None:
+         self.prepare()
+      return (candidate.owner is not None and
+              issubclass(candidate.owner, self.resolved))
+
+   def __repr__(self):
+      return "subclass_of(%s)" % ", ".join(
+         class_ if isinstance(class_, str) else class_.__name__
+         for class_ in self.classes)
+
+class named(Pointcut):
+   '''
+   Functions and methods whose names match any of the given glob patterns,
+   e.g. named("move*") for a name prefix.
+   '''
+   def __init__(self, *patterns):
+      self.patterns = patterns
+
+   def matches(self, candidate):
+      return any(fnmatch.fnmatchcase(candidate.name, pattern)
+                 for pattern in self.patterns)
+
+   def __repr__(self):
+      return "named(%s)" % ", ".join(map(repr, self.patterns))
+
+class functions(Pointcut):
+   '''
+   Module level functions.
+   '''
+   def matches(self, candidate):
+      return candidate.owner is None
+
+   def __repr__(self):
+      return "functions()"
+
+class methods(Pointcut):
+   '''
+   Methods, whether defined directly on a class or inherited.
+   '''
+   def matches(self, candidate):
+      return candidate.owner is not None
+
+   def __repr__(self):
+      return "methods()"
+
+class direct(Pointcut):
+   '''
+   Methods defined directly on a class rather than inherited from its bases.
+   '''
+   def matches(self, candidate):
+      return candidate.owner is not None and candidate.direct
+
+   def __repr__(self):
+      return "direct()"
+
+class inherited(Pointcut):
+   '''
+   Methods a class inherits from its bases without overriding them.
+   '''
+   def matches(self, candidate):
+      return candidate.owner is not None and not candidate.direct
+
+   def __repr__(self):
+      return "inherited()"
+
+class callables(Pointcut):
+   '''
+   The given functions and methods, or any other join points the weaver can
+   wrap (such as fields.writes(Point, "x")), so that a list of targets can be
+   combined with other pointcuts. It only covers the modules they come from.
+   '''
+   def __init__(self, *targets):
+      self.targets = targets
+      # Matched by location rather than identity, since Python 2 makes a new
+      # unbound method object every time one is looked up
+      self.keys = set(get_key(target) for target in targets)
+
+   def scope(self):
+      return set(key[0] for key in self.keys)
+
+   def matches(self, candidate):
+      return get_key(candidate.callable) in self.keys
+
+   def extra_candidates(self, module):
+      found = set(get_key(candidate.callable)
+                  for candidate in module_candidates(module))
+      return [Candidate(module, None, target.__name__, target, True, None)
+              for target in self.targets
+              if get_key(target)[0] == module.__name__
+              and get_key(target) not in found]
+
+   def __repr__(self):
+      return "callables(%s)" % ", ".join(
+         ".".join(part for part in get_key(target) if part)
+         for target in self.targets)
+
+class And(Pointcut):
+   def __init__(self, left, right):
+      self.left = left
+      self.right = right
+
+   def scope(self):
+      # Matches have to satisfy both sides, so either side's modules will do
+      left = self.left.scope()
+      return left if left is not None else self.right.scope()
+
+   def prepare(self):
+      self.left.prepare()
+      self.right.prepare()
+
+   def extra_candidates(self, module):
+      return (self.left.extra_candidates(module) +
+              self.right.extra_candidates(module))
+
+   def matches(self, candidate):
+      return self.left.matches(candidate) and self.right.matches(candidate)
+
+   def __repr__(self):
+      return "(%r & %r)" % (self.left, self.right)
+
+class Or(Pointcut):
+   def __init__(self, left, right):
+      self.left = left
+      self.right = right
+
+   def scope(self):
+      left, right = self.left.scope(), self.right.scope()
+      if left is None or right is None:
+         return None
+      return left | right
+
+   def prepare(self):
+      self.left.prepare()
+      self.right.prepare()
+
+   def extra_candidates(self, module):
+      return (self.left.extra_candidates(module) +
+              self.right.extra_candidates(module))
+
+   def matches(self, candidate):
+      return self.left.matches(candidate) or self.right.matches(candidate)
+
+   def __repr__(self):
+      return "(%r | %r)" % (self.left, self.right)
+
+class Not(Pointcut):
+   def __init__(self, pointcut):
+      self.pointcut = pointcut
+
+   def prepare(self):
+      self.pointcut.prepare()
+
+   def matches(self, candidate):
+      return not self.pointcut.matches(candidate)
+
+   def __repr__(self):
+      return "~%r" % (self.pointcut,)
@@ -0,0 +1,240 @@
+'''
+Index of every location in the program that has been woven, and of which
+aspects are wrapped around each one, so that the weaver never has to search
+for anything.
+'''
+import sys
+import weakref
+import inspect
+import collections
+
+def get_key(obj):
+   '''
+   Generate a tuple to identify a location in the original program structure:
+   the name of the module, the qualified name of the class (None for module
+   level functions) and the name of the callable. Only obj's own attributes
+   are consulted, so this costs the same however many modules are loaded, and
+   wrappers made with functools.wraps get the same key as what they wrap.
+   '''
+   owner = getattr(obj, "im_class", None)
+   if owner is not None:
+      # On Python 2, methods remember the class they were looked up on
+      return (owner.__module__, owner.__name__, obj.__name__)
+   module_name = getattr(obj, "__module__", None)
+   if module_name is None:
+      module = inspect.getmodule(obj)
+      if module is None:
+         raise ValueError("can't find the module %r belongs to" % (obj,))
+      module_name = module.__name__
+   path = getattr(obj, "__qualname__", obj.__name__).rpartition(".")[0]
+   return (module_name, path or None, obj.__name__)
+
+def find_owner(module, path):
+   '''
+   Follow a qualified class name (the middle part of a key) down from module
+   to the class it names, or to module itself if path is None. This always
+   finds whatever is there now, so after a class has been redefined it finds
+   the new class.
+   '''
+   owner = module
+   for part in (path.split(".") if path else ()):
+      if part == "<locals>":
+         raise ValueError("%s.%s is local to a function and can't be woven"
+                          % (module.__name__, path))
+      owner = getattr(owner, part)
+   return owner
+
+class Location(object):
+   '''
+   A place in the original program structure where a core callable lives:
+   the module, the class it is an attribute of (the module itself for
+   functions) and its name, along with the aspect instances wrapped around it,
+   innermost first, and the callable the weaver last put there. When the
+   weaver swaps code rather than attributes, function is the function whose
+   code it swaps and code is that function's own code.
+   '''
+   __slots__ = ("key", "module", "owner", "name", "core_callable", "aspects",
+                "woven", "function", "code", "__weakref__")
+
+   def __init__(self, key, core_callable):
+      module_name, path, name = key
+      self.key = key
+      self.name = name
+      self.core_callable = core_callable
+      self.woven = core_callable
+      self.aspects = []
+      self.function = None
+      self.code = None
+      self.module = sys.modules.get(module_name)
+      if self.module is None:
+         self.module = inspect.getmodule(core_callable)
+      self.owner = getattr(core_callable, "im_class", None)
+      if self.owner is None:
+         # On Python 3, follow the qualified name down from the module
+         self.owner = find_owner(self.module, path)
+
+   def __repr__(self):
+      return "<Location %s>" % ".".join(part for part in self.key if part)
+
+class Registry(object):
+   '''
+   All woven locations, indexed by key, by module name and by aspect class.
+
+   Locations are only held weakly, through one weak reference each; the other
+   indexes just have their keys. A location lasts as long as the callable the
+   weaver put in its place (see hold), so once a woven class or module has
+   been thrown away, e.g. by a plugin system that generates them, its
+   locations and aspect instances are garbage collected along with it. A
+   location without any aspects lasts only as long as someone is using it.
+   '''
+   def __init__(self):
+      # A weak reference to each location by key, which is put in collected
+      # when the location is garbage collected so that tidy can drop its keys
+      self.locations = {}
+      self.collected = []
+      self.by_module = collections.defaultdict(set)
+      self.by_aspect = collections.defaultdict(set)
+      # Locations with aspects whose woven callable is their core callable
+      # (because none of the aspects has any advice to run), which nothing
+      # else would hold on to
+      self.pinned = {}
+
+   def __iter__(self):
+      return iter(self.get_all(list(self.locations)))
+
+   def __len__(self):
+      self.tidy()
+      return len(self.locations)
+
+   def get(self, key):
+      '''
+      The location registered under key, or None.
+      '''
+      ref = self.locations.get(key)
+      return None if ref is None else ref()
+
+   def get_all(self, keys):
+      return [location for location in map(self.get, keys)
+              if location is not None]
+
+   def locate(self, callable_, create=False):
+      '''
+      Find the location of callable_, which may be the core callable or any
+      wrapper around it. If it hasn't been seen before, register it as a core
+      callable when create is true and return None otherwise.
+      '''
+      key = get_key(callable_)
+      location = self.get(key)
+      if location is None and create:
+         self.tidy()
+         location = Location(key, callable_)
+         self.insert(location)
+      return location
+
+   def insert(self, location):
+      '''
+      Register a new location, or one that was forgotten, e.g. when the weaver
+      restores a snapshot taken while it was still woven.
+      '''
+      key = location.key
+      self.locations[key] = weakref.KeyedRef(location, self.collected.append,
+                                             key)
+      self.by_module[key[0]].add(key)
+
+   def hold(self, location, woven):
+      '''
+      Keep location alive for as long as woven, the callable the weaver has
+      just put in place of its core callable, is.
+      '''
+      self.pinned.pop(location.key, None)
+      if woven is not location.core_callable:
+         try:
+            woven._location = location
+            return
+         except AttributeError:
+            pass
+      if location.aspects:
+         self.pinned[location.key] = location
+
+   def tidy(self):
+      '''
+      Drop the keys of locations that have been garbage collected.
+      '''
+      if not self.collected:
+         return
+      removed = 0
+      while self.collected:
+         ref = self.collected.pop()
+         if self.locations.get(ref.key) is not ref:
+            # Forgotten already, or registered again since
+            continue
+         del self.locations[ref.key]
+         removed += 1
+         self.discard(self.by_module, ref.key[0], ref.key)
+         for Aspect in list(self.by_aspect):
+            self.discard(self.by_aspect, Aspect, ref.key)
+      if removed > len(self.locations):
+         # Dicts never shrink by themselves, so once most of the locations are
+         # gone, what is left moves into a smaller one
+         self.locations = dict(self.locations)
+
+   def discard(self, index, name, key):
+      keys = index.get(name)
+      if keys is not None:
+         keys.discard(key)
+         if not keys:
+            del index[name]
+
+   def add(self, location, aspect_instance):
+      '''
+      Wrap aspect_instance as the outermost aspect at location.
+      '''
+      location.aspects.append(aspect_instance)
+      self.by_aspect[type(aspect_instance)].add(location.key)
+
+   def remove(self, location, aspect_instance):
+      location.aspects.remove(aspect_instance)
+      self.discard(self.by_aspect, type(aspect_instance), location.key)
+
+   def forget(self, location):
+      '''
+      Drop location and its aspects from the registry without touching the
+      program, e.g. because the module it was in has been reloaded.
+      '''
+      for aspect_instance in list(location.aspects):
+         self.remove(location, aspect_instance)
+      del self.locations[location.key]
+      self.pinned.pop(location.key, None)
+      self.discard(self.by_module, location.key[0], location.key)
+
+   def clear(self):
+      self.locations.clear()
+      self.by_module.clear()
+      self.by_aspect.clear()
+      self.pinned.clear()
+      del self.collected[:]
+
+   def aspects_on(self, callable_):
+      '''
+      The aspect instances wrapped around callable_, innermost first.
+      '''
+      location = self.locate(callable_)
+      return [] if location is None else list(location.aspects)
+
+   def locations_in(self, module_name):
+      '''
+      The woven locations in the named module.
+      '''
+      return self.get_all(list(self.by_module.get(module_name, ())))
+
+   def locations_of(self, Aspect):
+      '''
+      The locations Aspect itself (not its subclasses) is wrapped around.
+      '''
+      return self.get_all(list(self.by_aspect.get(Aspect, ())))
+
+   def callables_of(self, Aspect):
+      '''
+      The core callables Aspect itself (not its subclasses) is wrapped around.
+      '''
+      return [location.core_callable for location in self.locations_of(Aspect)]
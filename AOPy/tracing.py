@@ -0,0 +1,228 @@
+'''
+Cheap call tracing: TraceBase aspects write a fixed-size binary record for
+every call, return and exception into a preallocated ring buffer, and a
+background thread copies new records from the buffer to a file. Nothing is
+formatted or printed while the program runs; the file is decoded afterwards,
+e.g. into the same indented call tree TraceAspect in the examples prints:
+
+   python -m AOPy.tracing trace.bin
+
+Each record holds a sequence number, a timestamp, the thread id, a join point
+id (the woven callable, whose name is kept in a sidecar file next to the
+trace), the call depth and the event type. Writing one is a single
+struct.pack_into call, which no other Python thread can interrupt, and the
+sequence numbers let the flush thread tell which slots hold new records and
+notice when writers have lapped it, without any locking between the two.
+'''
+from __future__ import print_function
+import sys
+import json
+import time
+import struct
+import itertools
+import threading
+import collections
+
+try:
+   from threading import get_ident
+except ImportError:
+   from thread import get_ident
+
+ENTER = 1
+EXIT = 2
+EXCEPTION = 3
+
+# sequence, timestamp, thread id, join point id, depth, event type
+RECORD = struct.Struct("<QdQIHBx")
+SEQUENCE = struct.Struct("<Q")
+MAGIC = b"AOPYTRC1"
+
+Record = collections.namedtuple("Record",
+                                "sequence timestamp thread joinpoint depth "
+                                "event")
+
+class TraceRecorder(object):
+   '''
+   A ring buffer of capacity records that a background thread flushes to the
+   file at path every interval seconds. If more than capacity records are
+   written between flushes, the oldest ones are lost and counted in dropped.
+   '''
+   def __init__(self, path, capacity=262144, interval=0.1):
+      self.path = path
+      self.capacity = capacity
+      self.interval = interval
+      self.buffer = bytearray(capacity * RECORD.size)
+      # Sequence numbers start at 1, since an empty slot reads as 0
+      self.counter = itertools.count(1)
+      self.flushed = 0
+      self.dropped = 0
+      self.names = []
+      self.ids = {}
+      self.names_written = 0
+      self.record = self.make_record()
+      self.view = memoryview(self.buffer)
+      self.flush_lock = threading.Lock()
+      self.file = open(path, "wb")
+      self.file.write(MAGIC)
+      self.stopped = threading.Event()
+      self.thread = threading.Thread(target=self.run,
+                                     name="AOPy trace flusher")
+      self.thread.daemon = True
+      self.thread.start()
+
+   def joinpoint_id(self, name):
+      '''
+      Get the id records use for the join point called name.
+      '''
+      with self.flush_lock:
+         id_ = self.ids.get(name)
+         if id_ is None:
+            id_ = self.ids[name] = len(self.names)
+            self.names.append(name)
+         return id_
+
+   def make_record(self):
+      '''
+      Build the record(event, joinpoint, depth) function aspects call. It is
+      a closure over everything it needs, since it runs twice per traced call.
+      '''
+      pack_into = RECORD.pack_into
+      buffer = self.buffer
+      capacity = self.capacity
+      size = RECORD.size
+      counter = self.counter
+      clock = time.time
+      def record(event, joinpoint, depth):
+         sequence = next(counter)
+         pack_into(buffer, sequence % capacity * size, sequence, clock(),
+                   get_ident(), joinpoint, depth & 0xffff, event)
+      return record
+
+   def run(self):
+      while not self.stopped.wait(self.interval):
+         self.flush()
+
+   def flush(self):
+      '''
+      Copy every record written since the last flush to the file. Only the
+      slots the writers have been handed sequence numbers for since then are
+      copied and looked at, so a flush costs nothing much when little has
+      been traced.
+      '''
+      with self.flush_lock:
+         size = RECORD.size
+         capacity = self.capacity
+         newest = next_sequence(self.counter) - 1
+         expected = self.flushed + 1
+         if newest - expected >= capacity:
+            # The writers went all the way around the buffer since we last
+            # looked; skip to the oldest record that's still there
+            oldest = newest - capacity + 1
+            self.dropped += oldest - expected
+            expected = oldest
+         chunks = []
+         while expected <= newest:
+            slot = expected % capacity
+            end = min(capacity, slot + newest - expected + 1)
+            # Work on a copy, so the records can't change under us
+            chunk = self.view[slot * size:end * size].tobytes()
+            count = 0
+            for offset in range(0, len(chunk), size):
+               if SEQUENCE.unpack_from(chunk, offset)[0] != expected + count:
+                  break
+               count += 1
+            if count:
+               chunks.append(chunk[:count * size])
+               expected += count
+            if slot + count < end:
+               # A writer has its sequence number but hasn't written the
+               # record yet, or has since lapped us; either way the next
+               # flush sorts it out
+               break
+         self.flushed = expected - 1
+         if chunks:
+            self.file.write(b"".join(chunks))
+         if len(self.names) > self.names_written:
+            with open(self.path + ".names", "w") as names:
+               json.dump(self.names, names)
+            self.names_written = len(self.names)
+         self.file.flush()
+
+   def close(self):
+      '''
+      Stop the flush thread, write out whatever is left and close the file.
+      '''
+      if not self.stopped.is_set():
+         self.stopped.set()
+         self.thread.join()
+         self.flush()
+         self.file.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc_info):
+      self.close()
+
+def next_sequence(counter):
+   '''
+   The number an itertools.count will hand out next, without taking it.
+   '''
+   # Its repr is the only way to look at it that every version supports
+   return int(repr(counter)[len("count("):-1].rstrip("L"))
+
+def read(path):
+   '''
+   Decode a trace file into Records, with each join point id replaced by its
+   name.
+   '''
+   try:
+      with open(path + ".names") as names:
+         names = json.load(names)
+   except IOError:
+      names = []
+   with open(path, "rb") as trace:
+      if trace.read(len(MAGIC)) != MAGIC:
+         raise ValueError("%s isn't an AOPy trace" % (path,))
+      while True:
+         chunk = trace.read(RECORD.size)
+         if len(chunk) < RECORD.size:
+            break
+         record = Record(*RECORD.unpack(chunk))
+         if record.joinpoint < len(names):
+            record = record._replace(joinpoint=names[record.joinpoint])
+         yield record
+
+def format_tree(records):
+   '''
+   Turn records back into an indented call tree for each thread, in the
+   style of TraceAspect in the examples.
+   '''
+   threads = collections.OrderedDict()
+   for record in records:
+      threads.setdefault(record.thread, []).append(record)
+   lines = []
+   for thread, thread_records in threads.items():
+      if len(threads) > 1:
+         lines.append("thread %d:" % thread)
+      for record in thread_records:
+         level = record.depth + 1
+         if record.event == ENTER:
+            lines.append("--" * level + "> " + str(record.joinpoint))
+         elif record.event == EXIT:
+            lines.append("<" + "--" * level + " " + str(record.joinpoint))
+         else:
+            lines.append("<" + "xx" * level + " " + str(record.joinpoint))
+   return lines
+
+def main(argv=None):
+   argv = sys.argv[1:] if argv is None else argv
+   if len(argv) != 1:
+      print("usage: python -m AOPy.tracing TRACE_FILE", file=sys.stderr)
+      return 2
+   for line in format_tree(read(argv[0])):
+      print(line)
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main())
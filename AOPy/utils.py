@@ -1,5 +1,7 @@
+import types
 import inspect
 from operator import add
+from functools import reduce
 
 def all_classes(*modules):
    return reduce(add,
@@ -7,10 +9,26 @@ def all_classes(*modules):
                    inspect.getmembers(mod, predicate=inspect.isclass)]
                   for mod in modules])
 
+def _methods(class_):
+   '''
+   Get the (name, method) pairs for class_'s plain methods. What a method
+   looks like once it is looked up on the class differs between Python 2
+   and 3, so we go by what the class that defines it holds instead, and
+   leave out static and class methods, which would stop working if they
+   were replaced by a wrapper function.
+   '''
+   methods = []
+   for name, value in inspect.getmembers(class_):
+      for defining_class in inspect.getmro(class_):
+         if name in vars(defining_class):
+            if isinstance(vars(defining_class)[name], types.FunctionType):
+               methods.append((name, value))
+            break
+   return methods
+
 def all_methods(*classes):
    return reduce(add,
-                 [[pair[1] for pair in
-                   inspect.getmembers(class_, predicate=inspect.ismethod)]
+                 [[pair[1] for pair in _methods(class_)]
                   for class_ in classes])
 
 def direct_methods(*classes):
@@ -22,6 +40,5 @@ def direct_methods(*classes):
    undermine the goal of obliviousness.
    '''
    return reduce(add,
-                 [[pair[1] for pair in
-                   inspect.getmembers(class_, predicate=inspect.ismethod)
+                 [[pair[1] for pair in _methods(class_)
                    if pair[0] in vars(class_)] for class_ in classes])
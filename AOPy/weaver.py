@@ -1,85 +1,1003 @@
-import functools
+import sys
+import time
 import types
+import functools
 import inspect
+import weakref
+import threading
+import contextlib
 import collections
+from .registry import Registry, get_key, find_owner
+
+# Every woven location, with the aspect instances wrapped on its core callable
+registry = Registry()
+
+# Held while the registry or the woven attributes are being changed
+lock = threading.RLock()
+
+# While a batch is open, the locations whose wrappings are out of date, by key
+pending = None
+
+# While a batch is open, the locations whose existing wrappings just need to be
+# set on a new owner, by key
+moved = None
+
+# Either "layered" (one wrapper closure per aspect instance) or "compiled" (one
+# generated function per run of consecutive inlinable aspect instances)
+chain_mode = "layered"
+
+# Either "attribute" (set the outermost wrapper on the owner in place of the
+# core callable) or "code" (give the core callable's function the code of the
+# outermost wrapper, so references to it taken before weaving are woven too)
+backend = "attribute"
+
+# The header and body each compiled chain was generated from (see
+# compile_chain), by the chain's code, so that the code backend can compile
+# the chain into the woven function itself. What the body refers to is in the
+# chain's closure.
+compiled_chains = {}
 
-# Dictionary for retrieving the originally-created function/method object given
-# its module, class (if applicable), and name
-core_callables = {}
+# Code that woven functions run under the code backend, with a placeholder
+# for the location's key, by what it was generated from
+code_templates = {}
+KEY = "<AOPy key>"
 
-# Dictionary of lists of aspect instances wrapped on each core_callable
-aspect_orderings = collections.defaultdict(list)
+# The global under which woven functions find the callables their code calls,
+# by location key. They can't be constants in the code itself: code objects
+# are invisible to the garbage collector, so a chain that refers back to its
+# function (as through the function's globals) would never be collected.
+WOVEN = "__AOPy_woven__"
 
-def get_key(obj):
+# While instrumentation is on, the AOPy.instrumentation.Recorder that builds
+# timed chains and collects weaving times
+recorder = None
+
+# The code of the wrappers and aspect __call__ methods that woven chains are
+# made of, so that the caller of a woven callable can be told apart from them
+chain_codes = weakref.WeakSet()
+
+# The function compile_chain generated for each source to make chains with,
+# since many chains come out the same
+chain_sources = {}
+
+# While any snapshot is open, what each location looked like before each
+# change made to it since the oldest one, in order; see snapshot()
+journal = None
+open_snapshots = weakref.WeakSet()
+
+ADVICE_NAMES = ("before_advice", "after_advice", "after_exception_advice")
+
+# Neither exists before Python 3.5/3.6, and neither kind of function can either
+_iscoroutinefunction = getattr(inspect, "iscoroutinefunction",
+                               lambda obj: False)
+_isasyncgenfunction = getattr(inspect, "isasyncgenfunction",
+                              lambda obj: False)
+
+def get_kind(callable_):
    '''
-   Generate a tuple to identify a location in the original program structure.
+   Classify callable_ as a "function", "coroutine" or "async generator", which
+   determines what sort of wrapper each aspect gets.
    '''
-   return (inspect.getmodule(obj),
-           obj.im_class if isinstance(obj, types.MethodType) else None,
-           obj.__name__)
+   if _iscoroutinefunction(callable_):
+      return "coroutine"
+   if _isasyncgenfunction(callable_):
+      return "async generator"
+   return "function"
 
 def install(Aspect, callable_):
    '''
    Wrap a new aspect as the outermost aspect atop callable_.
    '''
-   key = get_key(callable_)
-   if key not in core_callables:
-      core_callables[key] = callable_
-   core_callable = core_callables[key]
-   for aspect_instance in aspect_orderings[core_callable]:
-      if isinstance(aspect_instance, Aspect):
-         # Don't allow multiple instances of an aspect on the same core_callable
-         return
-   aspect_orderings[core_callable].append(Aspect(None, core_callable))
-   update_wrappings(core_callable)
+   with lock:
+      location = registry.locate(callable_)
+      if location is None:
+         location = registry.locate(callable_, create=True)
+         if backend == "code":
+            adopt_code(location)
+         touch(location, existed=False)
+      for aspect_instance in location.aspects:
+         if isinstance(aspect_instance, Aspect):
+            # Don't allow multiple instances of an aspect on the same
+            # core_callable
+            return
+      touch(location)
+      registry.add(location, new_instance(Aspect, location.core_callable))
+      update_wrappings(location)
 
 def uninstall(Aspect, callable_):
    '''
    Remove aspect from whichever wrapping layer it appears in.
    '''
-   key = get_key(callable_)
-   if key in core_callables:
-      core_callable = core_callables[key]
+   with lock:
+      location = registry.locate(callable_)
+      if location is not None:
+         # We don't currently allow more than one instance of the same aspect,
+         # but this is here anyway
+         to_remove = [aspect_instance for aspect_instance in location.aspects
+                      if isinstance(aspect_instance, Aspect)]
+         if len(to_remove) == 0:
+            return
+         touch(location)
+         for aspect_instance in to_remove:
+            registry.remove(location, aspect_instance)
+         update_wrappings(location)
 
-      # We don't currently allow more than one instance of the same aspect,
-      # but this is here anyway
-      to_remove = [aspect_instance
-                   for aspect_instance in aspect_orderings[core_callable]
-                   if isinstance(aspect_instance, Aspect)]
-      if len(to_remove) == 0:
-         return
-      for aspect_instance in to_remove:
-         aspect_orderings[core_callable].remove(aspect_instance)
-      update_wrappings(core_callable)
+def wrap_aspect(aspect_instance, next_callable, kind="function", links=None):
+   '''
+   Modify existing aspect instance to wrap next_callable. If a links list is
+   given, the change is recorded there for publish to make instead.
+   '''
+   link(aspect_instance, next_callable, links)
+   add_chain_code(type(aspect_instance).__call__)
+   if kind == "coroutine" and hasattr(aspect_instance, "coroutine_wrapper"):
+      wrapper = aspect_instance.coroutine_wrapper()
+   elif kind == "async generator" and hasattr(aspect_instance,
+                                              "async_generator_wrapper"):
+      wrapper = aspect_instance.async_generator_wrapper()
+   else:
+      # Aspects without async semantics of their own just advise the creation
+      # of the coroutine or async generator, like any other call
+      def wrapper(*args, **kwargs):
+         return aspect_instance(*args, **kwargs)
+   add_chain_code(wrapper)
+   return functools.wraps(next_callable)(wrapper)
+
+def new_instance(Aspect, core_callable):
+   '''
+   Make the instance of Aspect for a new target. Stateless aspects share one
+   instance between all their targets, if it can be inlined there.
+   '''
+   if Aspect.stateless and is_inlinable(Aspect, get_kind(core_callable)):
+      aspect_instance = vars(Aspect).get("shared_instance")
+      if aspect_instance is None:
+         aspect_instance = Aspect.shared_instance = Aspect(None, None)
+         # Bound once here, or every chain would get bound methods of its own
+         Aspect.shared_advice = overridden_advice(aspect_instance)
+      return aspect_instance
+   return Aspect(None, core_callable)
+
+def is_shared(aspect_instance):
+   return vars(type(aspect_instance)).get("shared_instance") is aspect_instance
+
+def is_inlinable(aspect_instance, kind="function"):
+   '''
+   Determine whether aspect_instance can be folded into a compiled chain. That
+   is only safe when the class supplying its __call__ declares (with
+   `inlinable = True` next to the __call__ definition) that the __call__ does
+   nothing but run the advice around next_callable. A subclass that overrides
+   __call__ without redeclaring `inlinable` is left as its own layer.
+   Async generators always get their own layers. aspect_instance may also be
+   an aspect class.
+   '''
+   if kind == "async generator":
+      return False
+   if (kind == "coroutine"
+       and not hasattr(aspect_instance, "coroutine_wrapper")):
+      return False
+   Aspect = (aspect_instance if isinstance(aspect_instance, type)
+             else type(aspect_instance))
+   for class_ in Aspect.__mro__:
+      if "__call__" in vars(class_):
+         return vars(class_).get("inlinable", False)
+   return False
+
+def overridden_advice(aspect_instance):
+   '''
+   Get the bound advice methods of aspect_instance, in the order of
+   ADVICE_NAMES, with None standing in for each do-nothing default inherited
+   from AspectBase.
+   '''
+   # base imports this module, so we can only go the other way once both
+   # modules are loaded
+   from .base import AspectBase
+   advice = []
+   for name in ADVICE_NAMES:
+      method = getattr(aspect_instance, name)
+      default = getattr(AspectBase, name)
+      if getattr(method, "__func__", method) is getattr(default, "__func__",
+                                                       default):
+         advice.append(None)
+      else:
+         advice.append(method)
+   return advice
+
+def compile_chain(aspect_instances, next_callable, kind="function",
+                  links=None):
+   '''
+   Generate a single function that runs the advice of every instance in
+   aspect_instances (innermost first, as in Location.aspects) around
+   next_callable, with the same nesting of try blocks the layered wrappers
+   would produce. Advice that isn't overridden is left out entirely, so a run
+   of aspects with no advice at all compiles to next_callable itself. For
+   coroutines the generated function is a coroutine function that awaits
+   next_callable. links works as in wrap_aspect.
+   '''
+   header, body = chain_start(kind)
+   namespace = {"next_callable": next_callable}
+   for i, aspect_instance in enumerate(aspect_instances):
+      if is_shared(aspect_instance):
+         # It has no single next_callable, and its advice is bound already
+         before, after, exception = type(aspect_instance).shared_advice
+      else:
+         # Inlined aspects have no layer of their own, so the closest thing
+         # to a next_callable we can give them is whatever the whole run wraps
+         link(aspect_instance, next_callable, links)
+         before, after, exception = overridden_advice(aspect_instance)
+      if before is None and after is None and exception is None:
+         continue
+      lines = []
+      if before is not None:
+         namespace["before_%d" % i] = before
+         lines.append("before_%d(*args, **kwargs)" % i)
+      if exception is not None:
+         namespace["exception_%d" % i] = exception
+         lines.append("try:")
+         lines.extend("   " + line for line in body)
+         lines.append("except Exception as e:")
+         lines.append("   exception_%d(e, *args, **kwargs)" % i)
+         lines.append("   raise")
+         if after is not None:
+            lines.append("else:")
+            lines.append("   after_%d(result, *args, **kwargs)" % i)
+      else:
+         lines.extend(body)
+         if after is not None:
+            lines.append("after_%d(result, *args, **kwargs)" % i)
+      if after is not None:
+         namespace["after_%d" % i] = after
+      body = lines
+   if len(body) == 1:
+      return next_callable
+   # What the chain calls goes in its closure rather than in globals of its
+   # own, which would cost a dict per chain
+   names = sorted(namespace)
+   source = "\n".join(["def chain(%s):" % ", ".join(names), "   " + header] +
+                      ["      " + line for line in body] +
+                      ["      return result", "   return dispatch", ""])
+   chain = chain_sources.get(source)
+   if chain is None:
+      globals_ = {}
+      exec(compile(source, "<AOPy compiled chain>", "exec"), globals_)
+      chain = chain_sources[source] = globals_["chain"]
+   dispatch = chain(*[namespace[name] for name in names])
+   if dispatch.__code__ not in compiled_chains:
+      add_chain_code(dispatch)
+      compiled_chains[dispatch.__code__] = (header, body)
+   return functools.wraps(next_callable)(dispatch)
+
+def chain_start(kind):
+   '''
+   The header and body of a generated function that just calls next_callable,
+   which compile_chain then wraps advice around.
+   '''
+   if kind == "coroutine":
+      return ("async def dispatch(*args, **kwargs):",
+              ["result = await next_callable(*args, **kwargs)"])
+   return ("def dispatch(*args, **kwargs):",
+           ["result = next_callable(*args, **kwargs)"])
+
+def add_chain_code(callable_):
+   '''
+   Remember that frames running callable_'s code are part of a woven chain
+   rather than the program itself.
+   '''
+   code = getattr(getattr(callable_, "__func__", callable_), "__code__", None)
+   if code is not None:
+      chain_codes.add(code)
+
+def find_caller(frame):
+   '''
+   Starting from a frame running some aspect's advice (or anything it calls),
+   walk out to the chain the advice is running in and return the first frame
+   outside it, which is the frame that called the woven callable.
+   '''
+   while frame is not None and frame.f_code not in chain_codes:
+      frame = frame.f_back
+   while frame is not None and frame.f_code in chain_codes:
+      frame = frame.f_back
+   return frame
+
+def link(aspect_instance, next_callable, links=None):
+   if links is None:
+      aspect_instance.next_callable = next_callable
+   else:
+      links.append((aspect_instance, next_callable))
+
+def set_chain_mode(mode):
+   '''
+   Choose between "layered" and "compiled" wrapper chains and rebuild every
+   chain that has already been woven.
+   '''
+   global chain_mode
+   if mode not in ("layered", "compiled"):
+      raise ValueError("unknown chain mode: %r" % (mode,))
+   with batch("set_chain_mode"):
+      chain_mode = mode
+      for location in registry:
+         touch(location)
+         update_wrappings(location)
+
+def set_backend(name):
+   '''
+   Choose between the "attribute" and "code" backends and move everything
+   already woven over. The code backend leaves the owner's attribute alone
+   and swaps the code of the function there instead, so references taken
+   before weaving (from module import function, stored bound methods,
+   registered callbacks) call the aspects too, and unweaving gives the
+   function back its own code object. Callables that aren't plain functions
+   are still woven by attribute. This is best done before weaving anything,
+   since callers can briefly see the callables moved over unwoven.
+   '''
+   global backend
+   if name not in ("attribute", "code"):
+      raise ValueError("unknown backend: %r" % (name,))
+   with lock:
+      if open_snapshots:
+         raise ValueError("can't switch backends while a snapshot is open")
+      with batch("set_backend"):
+         backend = name
+         restored = []
+         for location in registry:
+            if name == "code" and location.function is None:
+               if adopt_code(location):
+                  # The owner gets the function itself back, and the wrappers
+                  # move into its code when the batch ends
+                  restored.append((location.owner, location.name,
+                                   location.function))
+            elif name == "attribute" and location.function is not None:
+               restored.append((location.function, "__code__", location.code))
+               release_code(location)
+            update_wrappings(location)
+         with uninterrupted():
+            for obj, attribute, value in restored:
+               setattr(obj, attribute, value)
+
+def adopt_code(location):
+   '''
+   Switch location over to the code backend, if its core callable is a plain
+   function (or, on Python 2, an unbound method) and its owner doesn't ask
+   for the attribute backend with `woven_by_attribute = True`: the chain gets
+   a copy of the function to call, and the function itself is what gets
+   woven. Return whether it was switched.
+   '''
+   core_callable = location.core_callable
+   function = getattr(core_callable, "__func__", core_callable)
+   if (not isinstance(function, types.FunctionType) or
+       getattr(core_callable, "__self__", None) is not None or
+       getattr(location.owner, "woven_by_attribute", False)):
+      return False
+   copy = types.FunctionType(function.__code__, function.__globals__,
+                             function.__name__, function.__defaults__,
+                             function.__closure__)
+   copy.__dict__.update(function.__dict__)
+   for name in ("__module__", "__doc__", "__qualname__", "__kwdefaults__"):
+      if hasattr(function, name):
+         setattr(copy, name, getattr(function, name))
+   if core_callable is not function:
+      copy = types.MethodType(copy, None, core_callable.im_class)
+   location.function = function
+   location.code = function.__code__
+   set_core(location, copy)
+   return True
+
+def release_code(location):
+   '''
+   Switch location back to the attribute backend. The caller is responsible
+   for giving location.function its own code back.
+   '''
+   function = location.function
+   if "__wrapped__" not in vars(core_function(location)):
+      vars(function).pop("__wrapped__", None)
+   core_callable = function
+   if hasattr(location.core_callable, "im_class"):
+      core_callable = types.MethodType(function, None,
+                                       location.core_callable.im_class)
+   location.function = None
+   location.code = None
+   set_core(location, core_callable)
+   location.woven = core_callable
+
+def set_core(location, core_callable):
+   location.core_callable = core_callable
+   for aspect_instance in location.aspects:
+      if not is_shared(aspect_instance):
+         aspect_instance.core_callable = core_callable
+
+def core_function(location):
+   return getattr(location.core_callable, "__func__", location.core_callable)
+
+def woven_code(location, callable_):
+   '''
+   Build the code location.function should run to call callable_: its own
+   code if callable_ is the core callable, the code of callable_ itself if it
+   is a compiled chain (so that the chain needs no frame of its own), and
+   otherwise code that just calls callable_. Return that code and the values
+   it expects to find under the location's key in WOVEN (see swap_code), or
+   None for the function's own code.
+   '''
+   if callable_ is location.core_callable:
+      return location.code, None
+   source = compiled_chains.get(getattr(callable_, "__code__", None))
+   if source is None:
+      header, body = chain_start(get_kind(location.core_callable))
+      namespace = {"next_callable": callable_}
+   else:
+      header, body = source
+      cells = [cell.cell_contents for cell in callable_.__closure__]
+      namespace = dict(zip(callable_.__code__.co_freevars, cells))
+   names = sorted(namespace)
+   function = location.function
+   free = len(function.__code__.co_freevars)
+   template = code_templates.get((header, tuple(body), free))
+   if template is None:
+      template = code_template(header, body, names, free)
+      code_templates[(header, tuple(body), free)] = template
+   constants = tuple(location.key if constant == KEY else constant
+                     for constant in template.co_consts)
+   code = replace_code(template, constants, function.__code__)
+   chain_codes.add(code)
+   # callable_ goes last, unused, since it is what keeps the location alive
+   # (see Registry.hold)
+   return code, tuple(namespace[name] for name in names) + (callable_,)
+
+def code_template(header, body, names, free):
+   '''
+   Compile a generated function into code that a woven function can run.
+   That code runs with the woven function's globals, so it starts by taking
+   everything the body refers to by name out of WOVEN, under a placeholder
+   for the location's key; and since a function's code can only be replaced
+   by code with as many free variables, it gets that many unused ones.
+   '''
+   variables = ["free_%d" % i for i in range(free)]
+   lines = ["def outer():"]
+   if variables:
+      lines.append("   %s = None" % " = ".join(variables))
+   lines.append("   " + header)
+   lines.append("      %s, woven = %s[%r]" % (", ".join(names), WOVEN, KEY))
+   lines.extend("      " + line for line in body)
+   lines.append("      return result")
+   if variables:
+      lines.append("      " + ", ".join(variables) + ",")
+   lines.append("   return dispatch")
+   namespace = {}
+   exec(compile("\n".join(lines) + "\n", "<AOPy woven code>", "exec"),
+        namespace)
+   return namespace["outer"]().__code__
 
-def wrap_aspect(aspect_instance, next_callable):
+def replace_code(code, constants, original):
    '''
-   Modify existing aspect instance to wrap next_callable.
+   Copy code with new constants, named after the original code it stands in
+   for so that tracebacks and profiles show the woven function's name.
    '''
-   aspect_instance.next_callable = next_callable
-   @functools.wraps(next_callable)
-   def wrapper(*args, **kwargs):
-      return aspect_instance(*args, **kwargs)
-   return wrapper
+   if hasattr(code, "replace"):
+      changes = {"co_consts": constants, "co_name": original.co_name}
+      if hasattr(code, "co_qualname"):
+         changes["co_qualname"] = original.co_qualname
+      return code.replace(**changes)
+   # Before Python 3.8, code objects can only be built from scratch
+   args = [code.co_argcount]
+   if hasattr(code, "co_kwonlyargcount"):
+      args.append(code.co_kwonlyargcount)
+   args.extend([code.co_nlocals, code.co_stacksize, code.co_flags,
+                code.co_code, constants, code.co_names, code.co_varnames,
+                code.co_filename, original.co_name, code.co_firstlineno,
+                code.co_lnotab, code.co_freevars, code.co_cellvars])
+   return types.CodeType(*args)
 
-def update_wrappings(core_callable):
+def swap_code(location, code, values=None):
    '''
-   Link all active aspects on core_callable with appropriate wrappings.
+   Give location.function code to run, along with the values woven code
+   takes out of WOVEN in the function's globals, keeping inspect.signature
+   pointed at the core callable while it isn't the function's own code.
    '''
-   aspect_ordering = aspect_orderings[core_callable]
+   function = location.function
+   woven = function.__globals__.get(WOVEN)
+   if values is not None:
+      if woven is None:
+         woven = function.__globals__[WOVEN] = {}
+      woven[location.key] = values
+   function.__code__ = code
+   if values is None and woven is not None:
+      woven.pop(location.key, None)
+      if not woven:
+         del function.__globals__[WOVEN]
+   if "__wrapped__" not in vars(core_function(location)):
+      if code is location.code:
+         vars(function).pop("__wrapped__", None)
+      else:
+         function.__wrapped__ = location.core_callable
+
+def build_wrappings(location, links):
+   '''
+   Build the chain of wrappers for all active aspects at location and return
+   its outermost callable. Nothing live is touched: the next_callable each
+   aspect instance should get is recorded in links.
+   '''
+   core_callable = location.core_callable
+   aspect_ordering = location.aspects
+   kind = get_kind(core_callable)
+   if recorder is not None:
+      callable_ = recorder.build_wrappings(location, kind, links)
+      if callable_ is not None:
+         return callable_
    callable_ = core_callable
-   for aspect_instance in aspect_ordering:
-      callable_ = wrap_aspect(aspect_instance, callable_)
-   if isinstance(core_callable, types.MethodType):
-      setattr(core_callable.im_class, core_callable.__name__, callable_)
+   if chain_mode == "compiled":
+      run = []
+      for aspect_instance in aspect_ordering:
+         if is_inlinable(aspect_instance, kind):
+            run.append(aspect_instance)
+            continue
+         if run:
+            callable_ = compile_chain(run, callable_, kind, links)
+            run = []
+         callable_ = wrap_aspect(aspect_instance, callable_, kind, links)
+      if run:
+         callable_ = compile_chain(run, callable_, kind, links)
    else:
-      setattr(inspect.getmodule(core_callable), core_callable.__name__, callable_)
+      for aspect_instance in aspect_ordering:
+         if is_shared(aspect_instance):
+            # A shared instance's layer has to be generated for each target
+            callable_ = compile_chain([aspect_instance], callable_, kind,
+                                      links)
+         else:
+            callable_ = wrap_aspect(aspect_instance, callable_, kind, links)
+   return callable_
+
+@contextlib.contextmanager
+def uninterrupted():
+   '''
+   Keep the interpreter from switching to another thread for the duration of
+   the block, unless the block itself blocks. This relies on the GIL, and only
+   makes sense for short stretches of code that don't do any I/O.
+
+   A thread that is already waiting for the GIL keeps waiting with the old
+   interval, and asks for the GIL back once that is up, even in the middle
+   of the block. So we give the GIL up once first; by the time we have it
+   again, every waiting thread is waiting with the new interval, and the
+   block is uninterrupted as long as it takes less than that (10ms). Giving
+   the GIL up costs the caller up to the new interval when another thread
+   is busy, which is why a batch only publishes once. The interval isn't
+   made infinite, since a busy thread that got the GIL would then keep it,
+   and us waiting, for good.
+   '''
+   if hasattr(sys, "setswitchinterval"):
+      interval = sys.getswitchinterval()
+      sys.setswitchinterval(0.01)
+      time.sleep(0.0001)
+      try:
+         yield
+      finally:
+         sys.setswitchinterval(interval)
+   else:
+      interval = sys.getcheckinterval()
+      sys.setcheckinterval(1000000)
+      try:
+         yield
+      finally:
+         sys.setcheckinterval(interval)
+
+def publish(links, patches):
+   '''
+   Make newly built chains live: relink the aspect instances and set each
+   rebuilt callable on its owner, all without letting another thread run in
+   between, so no caller ever sees a half-woven class or a chain whose
+   aspects point into a different chain. Under the code backend, it is the
+   code of each woven function that is set instead.
+   '''
+   codes = [None if location.function is None else
+            woven_code(location, callable_)
+            for location, callable_ in patches]
+   with uninterrupted():
+      for aspect_instance, next_callable in links:
+         aspect_instance.next_callable = next_callable
+      for (location, callable_), code in zip(patches, codes):
+         if code is None:
+            setattr(location.owner, location.name, callable_)
+         else:
+            swap_code(location, *code)
+         location.woven = callable_
+   for location, callable_ in patches:
+      registry.hold(location, callable_)
+
+def update_wrappings(location):
+   '''
+   Link all active aspects at location with appropriate wrappings. Inside a
+   batch this only marks the location as out of date.
+   '''
+   with lock:
+      if pending is not None:
+         pending[location.key] = location
+         return
+      if recorder is not None:
+         start = recorder.clock()
+      links = []
+      callable_ = build_wrappings(location, links)
+      publish(links, [(location, callable_)])
+      if recorder is not None:
+         recorder.record_weaving("update_wrappings", recorder.clock() - start,
+                                 1)
+
+def republish(location):
+   '''
+   Set the wrappings already built for location on its owner again, e.g.
+   because the owner has been replaced. Inside a batch this is deferred like
+   update_wrappings.
+   '''
+   with lock:
+      if moved is not None:
+         moved[location.key] = location
+         return
+      publish([], [(location, location.woven)])
+
+@contextlib.contextmanager
+def batch(label="batch"):
+   '''
+   Defer rebuilding wrappings until the end of the block, then rebuild every
+   location that changed once and publish them all together. Batches can be
+   nested; only the outermost one publishes. Other threads that want to weave
+   wait for the batch to finish. With instrumentation on, the time the whole
+   block takes is recorded under label.
+   '''
+   global pending, moved
+   with lock:
+      if pending is not None:
+         yield
+         return
+      start = recorder.clock() if recorder is not None else None
+      pending = {}
+      moved = {}
+      try:
+         yield
+      finally:
+         locations, pending = pending, None
+         relocated, moved = moved, None
+         links = []
+         patches = [(location, build_wrappings(location, links))
+                    for location in locations.values()]
+         patches.extend((location, location.woven)
+                        for key, location in relocated.items()
+                        if key not in locations)
+         publish(links, patches)
+         if recorder is not None and start is not None:
+            recorder.record_weaving(label, recorder.clock() - start,
+                                    len(patches))
+
+def forget(location):
+   '''
+   Drop location from the registry without putting its core callable back,
+   because whatever it was an attribute of has been replaced.
+   '''
+   with lock:
+      touch(location)
+      for deferred in (pending, moved):
+         if deferred is not None:
+            deferred.pop(location.key, None)
+      registry.forget(location)
+
+def same_code(old, new):
+   '''
+   Determine whether the function new, e.g. from a reloaded module, behaves
+   exactly like old, so the wrappers built around old can stay. Functions
+   with closures never count as the same, since the cells could hold anything
+   (a method's __class__ cell holds the old class, for one).
+   '''
+   return (old.__code__ == new.__code__ and
+           old.__globals__ is new.__globals__ and
+           old.__closure__ is None and new.__closure__ is None and
+           old.__defaults__ == new.__defaults__ and
+           getattr(old, "__kwdefaults__", None) ==
+           getattr(new, "__kwdefaults__", None))
+
+def current_owner(location):
+   '''
+   Find what location's owner is now. If it can't be found by name (Python 2
+   only knows the innermost name of nested classes), assume it hasn't changed.
+   '''
+   try:
+      return find_owner(location.module, location.key[1])
+   except AttributeError:
+      return location.owner
+
+def is_stale(location):
+   '''
+   Determine whether location's module or class has been reloaded or
+   redefined since it was woven, i.e. whether what is there now isn't what the
+   weaver put there.
+   '''
+   owner = current_owner(location)
+   if location.function is not None:
+      current = vars(owner).get(location.name)
+      return (owner is not location.owner or
+              getattr(current, "__func__", current) is not location.function)
+   return (owner is not location.owner or
+           vars(owner).get(location.name) is not location.woven)
+
+def refresh_location(location):
+   '''
+   Bring one stale location up to date with what is in the program now.
+   '''
+   touch(location)
+   if location.function is not None:
+      refresh_code_location(location)
+      return
+   owner = current_owner(location)
+   current = vars(owner).get(location.name)
+   if current is location.woven:
+      # Only the owner is new, and it got our wrappings anyway
+      location.owner = owner
+   elif not isinstance(current, types.FunctionType):
+      # Removed, or replaced by something we don't weave
+      forget(location)
+   elif same_code(getattr(location.core_callable, "__func__",
+                          location.core_callable), current):
+      if owner is not location.owner and hasattr(location.core_callable,
+                                                 "im_class"):
+         # Python 2 methods only accept instances of their own class, so
+         # the chain has to be rebuilt around one for the new class
+         set_core(location, types.MethodType(location.core_callable.__func__,
+                                             None, owner))
+         location.owner = owner
+         update_wrappings(location)
+      else:
+         location.owner = owner
+         republish(location)
+   else:
+      # Changed, so the aspects start over on the new code, with fresh
+      # instances since their state belongs to the old one
+      if hasattr(location.core_callable, "im_class"):
+         current = types.MethodType(current, None, owner)
+      location.owner = owner
+      location.core_callable = current
+      location.aspects[:] = [new_instance(type(aspect_instance), current)
+                             for aspect_instance in location.aspects]
+      update_wrappings(location)
+
+def refresh_code_location(location):
+   '''
+   refresh_location for a location woven by swapping code. The function that
+   was woven gets its own code back, since it isn't in the program any more,
+   and the aspects move over to whatever function is there now.
+   '''
+   owner = current_owner(location)
+   current = vars(owner).get(location.name)
+   if getattr(current, "__func__", current) is location.function:
+      # Only the owner is new, and it has our function anyway
+      location.owner = owner
+      return
+   unchanged = isinstance(current, types.FunctionType) and same_code(
+      core_function(location), current)
+   swap_code(location, location.code)
+   if unchanged and not hasattr(location.core_callable, "im_class"):
+      # The chain can stay as it is, calling the old copy of the same code;
+      # only the new function has to be given the woven code
+      location.owner = owner
+      location.function = current
+      location.code = current.__code__
+      republish(location)
+      return
+   release_code(location)
+   if not isinstance(current, types.FunctionType):
+      forget(location)
+      return
+   if hasattr(location.core_callable, "im_class"):
+      current = types.MethodType(current, None, owner)
+   location.owner = owner
+   if unchanged:
+      set_core(location, current)
+   else:
+      location.core_callable = current
+      location.aspects[:] = [new_instance(type(aspect_instance), current)
+                             for aspect_instance in location.aspects]
+   if backend == "code":
+      adopt_code(location)
+   update_wrappings(location)
+
+def refresh(target=None, aspects=()):
+   '''
+   Re-weave after a module has been reloaded or a class redefined, where
+   target is the module or the new class, or None to check everything woven.
+   Each woven callable that is no longer in place is compared with its
+   replacement: unchanged code keeps its existing wrappers, changed code gets
+   fresh ones, and removed callables are dropped from the registry. Aspects
+   whose targets are pointcuts covering the module (any already woven, plus
+   those given in aspects) are then installed on any matching callables that
+   aren't woven yet. Only the callables that changed are rebuilt.
+   '''
+   from .pointcuts import Pointcut, invalidate
+   with lock:
+      if target is None:
+         modules = set(location.key[0] for location in registry
+                       if is_stale(location))
+         with batch("refresh"):
+            for module_name in modules:
+               module = sys.modules.get(module_name)
+               if module is not None:
+                  refresh(module, aspects)
+         return
+      if isinstance(target, types.ModuleType):
+         module, path = target, None
+      else:
+         module = sys.modules[target.__module__]
+         path = getattr(target, "__qualname__", target.__name__)
+      invalidate(module.__name__)
+      with batch("refresh"):
+         for location in registry.locations_in(module.__name__):
+            if path is not None and location.key[1] != path and not (
+               location.key[1] or "").startswith(path + "."):
+               continue
+            if is_stale(location):
+               refresh_location(location)
+         # Only callables that weren't woven before count as added; the rest
+         # keep the aspects they had
+         known = set(location.key
+                     for location in registry.locations_in(module.__name__))
+         candidates = list(aspects)
+         candidates.extend(Aspect for Aspect in list(registry.by_aspect)
+                           if Aspect not in candidates)
+         for Aspect in candidates:
+            pointcut = Aspect.targets
+            if not isinstance(pointcut, Pointcut) or not pointcut.covers(
+               module.__name__):
+               continue
+            for callable_ in pointcut.resolve_in(module):
+               key = get_key(callable_)
+               if key not in known and (path is None or key[1] == path):
+                  install(Aspect, callable_)
 
 def reset_all():
    '''
    Restore original callables and clear all bookkeeping data.
    '''
-   aspect_orderings = collections.defaultdict(list)
-   for core_callable_ in core_callables.itervalues():
-      update_wrappings(core_callable)
-   core_callables = {}
+   with lock:
+      with batch("reset_all"):
+         for location in registry:
+            touch(location)
+            del location.aspects[:]
+            update_wrappings(location)
+      registry.clear()
+
+def touch(location, existed=True):
+   '''
+   Note what location looks like before it is changed, if an open snapshot
+   might have to go back to it: its aspect instances with what each one
+   wraps, and the callable that is live there. existed is false for a
+   location that has only just been registered, which restoring drops from
+   the registry again.
+   '''
+   global journal
+   if journal is None:
+      return
+   if not open_snapshots:
+      # Every snapshot was thrown away without being restored or closed
+      journal = None
+      return
+   if pending is not None and location.key in pending:
+      # Changed earlier in this batch, so what is live isn't what the
+      # aspects add up to; restoring will have to rebuild it
+      woven = None
+   else:
+      woven = location.woven
+   journal.append((location, existed,
+                   [(aspect_instance, aspect_instance.next_callable)
+                    for aspect_instance in location.aspects],
+                   location.owner, location.core_callable, woven,
+                   location.function, location.code))
+
+class Snapshot(object):
+   '''
+   The weaving state at some point, as returned by snapshot(). All it holds
+   is where the journal was at the time, and the settings that decide how
+   chains are built; the journal itself has what to go back to.
+   '''
+   def __init__(self, position):
+      self.position = position
+      self.chain_mode = chain_mode
+      self.recorder = recorder
+
+   def close(self):
+      '''
+      Stop journaling for this snapshot without restoring it.
+      '''
+      global journal
+      with lock:
+         open_snapshots.discard(self)
+         if not open_snapshots:
+            journal = None
+
+def snapshot():
+   '''
+   Remember which aspects are woven where, so that restore() can put things
+   back the way they are now. This costs the same however much is woven: from
+   now on, the weaver notes each location's state before it changes, until
+   the snapshot is restored and closed, or garbage collected.
+   '''
+   global journal
+   with lock:
+      if journal is None:
+         journal = []
+      result = Snapshot(len(journal))
+      open_snapshots.add(result)
+      return result
+
+def restore(snapshot):
+   '''
+   Put every location changed since snapshot was taken back the way it was,
+   with the same aspect instances in the same order, and drop the locations
+   that were registered since. Only those locations are touched, and unless
+   instrumentation was turned on or off in between, nothing is rebuilt: the
+   callables that were live at the time go back on their owners. Later
+   snapshots are invalidated; this one stays open and can be restored again.
+   '''
+   global chain_mode
+   with lock:
+      if snapshot not in open_snapshots or snapshot.position > len(journal):
+         raise ValueError("snapshot has been closed or undone already")
+      changes = journal[snapshot.position:]
+      del journal[snapshot.position:]
+      for later in list(open_snapshots):
+         if later.position > snapshot.position:
+            open_snapshots.discard(later)
+      # Going through the changes newest first leaves each location with the
+      # state it had before the first of them
+      earliest = collections.OrderedDict()
+      for change in reversed(changes):
+         earliest[change[0]] = change
+      # Locations registered since go first, in case one of them took the
+      # key of a location that was forgotten since
+      changes = sorted(earliest.values(), key=lambda change: change[1])
+      # set_chain_mode notes every location it rebuilds, so the chains those
+      # locations had are among the changes; instrumentation doesn't
+      chain_mode = snapshot.chain_mode
+      exact = recorder is snapshot.recorder
+      links = []
+      patches = []
+      with batch("restore"):
+         for (location, existed, aspects, owner, core_callable, woven,
+              function, code) in changes:
+            for aspect_instance in list(location.aspects):
+               registry.remove(location, aspect_instance)
+            if location.function not in (None, function):
+               # Woven since, in place of a function that was reloaded
+               swap_code(location, location.code)
+            location.owner = owner
+            location.core_callable = core_callable
+            location.function = function
+            location.code = code
+            if not existed:
+               pending.pop(location.key, None)
+               moved.pop(location.key, None)
+               if registry.get(location.key) is location:
+                  registry.forget(location)
+               patches.append((location, core_callable))
+               continue
+            if registry.get(location.key) is not location:
+               registry.insert(location)
+            for aspect_instance, next_callable in aspects:
+               registry.add(location, aspect_instance)
+            if exact and woven is not None:
+               pending.pop(location.key, None)
+               moved.pop(location.key, None)
+               links.extend(aspects)
+               patches.append((location, woven))
+            else:
+               update_wrappings(location)
+      publish(links, patches)
+
+@contextlib.contextmanager
+def isolated():
+   '''
+   Undo whatever weaving the block does when it ends, e.g. around a test that
+   enables aspects:
+
+      with weaver.isolated():
+         MyAspect.enable()
+         ...
+   '''
+   state = snapshot()
+   try:
+      yield state
+   finally:
+      try:
+         restore(state)
+      finally:
+         state.close()
@@ -0,0 +1,75 @@
+'''
+Per-call cost of DepthBase and CFlowBase context state.
+
+DepthBase and CFlowBase keep their state in per-thread, per-task context
+variables; this compares them with the class attributes they used to share
+between every thread.
+'''
+from __future__ import print_function
+from common import per_call, report
+from AOPy import AspectBase, DepthBase, CFlowBase
+
+class ClassAttributeDepthBase(AspectBase):
+   # DepthBase as it was before it kept its counter in a ContextVar
+   depth = 0
+
+   def __call__(self, *args, **kwargs):
+      self.before_advice(*args, **kwargs)
+      self.__class__.depth += 1
+      try:
+         result = self.next_callable(*args, **kwargs)
+      except Exception as e:
+         self.__class__.depth -= 1
+         self.after_exception_advice(e, *args, **kwargs)
+         raise
+      else:
+         self.__class__.depth -= 1
+         self.after_advice(result, *args, **kwargs)
+      return result
+
+class ClassAttributeCFlowBase(AspectBase):
+   # CFlowBase as it was before it kept its flag in a ContextVar
+   within_cflow = False
+
+   def __call__(self, *args, **kwargs):
+      if self.__class__.within_cflow:
+         return self.next_callable(*args, **kwargs)
+      else:
+         self.before_advice(*args, **kwargs)
+         self.__class__.within_cflow = True
+         try:
+            result = self.next_callable(*args, **kwargs)
+         except Exception as e:
+            self.__class__.within_cflow = False
+            self.after_exception_advice(e, *args, **kwargs)
+            raise
+         else:
+            self.__class__.within_cflow = False
+            self.after_advice(result, *args, **kwargs)
+         return result
+
+def target(x):
+   return x
+
+def nested(x):
+   # A call that is already inside the cflow, to time CFlowBase's fast path
+   return woven_inner(x)
+
+def run():
+   global woven_inner
+   results = [("unwoven", per_call(lambda: target(1)))]
+   for base in (ClassAttributeDepthBase, DepthBase,
+                ClassAttributeCFlowBase, CFlowBase):
+      class Aspect(base):
+         targets = []
+      outer = Aspect(target, target)
+      results.append((base.__name__, per_call(lambda: outer(1))))
+      if "CFlow" in base.__name__:
+         woven_inner = Aspect(target, target)
+         outer = Aspect(nested, nested)
+         results.append((base.__name__ + " (nested)",
+                         per_call(lambda: outer(1))))
+   return results
+
+if __name__ == "__main__":
+   report(__doc__.strip().splitlines()[0], run())
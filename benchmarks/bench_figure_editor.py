@@ -0,0 +1,87 @@
+'''
+Moving a whole figure in the figure editor example, with and without aspects.
+
+The canvas holds POLYGONS polygons of LINES lines each, so each move_by on
+the canvas makes 1 + POLYGONS * (1 + LINES * 3) calls to move_by methods.
+The aspects are stand-ins for the ones in examples/sample_aspects.py that do
+the same amount of bookkeeping without printing anything:
+
+   observer: the display update that should happen once per top level move,
+             which is what CFlowBase is for
+   trace: counting calls and call depth with DepthBase
+   callers: looking at who made each call with CallBase
+   tracing: recording every call with TraceBase, as a stand-in for the
+            printing TraceAspect
+'''
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+from common import per_call, report
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "examples"))
+import sample_classes
+from AOPy import (CFlowBase, DepthBase, CallBase, TraceBase, enable_all,
+                  weaver, tracing)
+from AOPy.pointcuts import within, named
+
+POLYGONS = 10
+LINES = 10
+
+moves = within("sample_classes") & named("move_by")
+
+class Observer(CFlowBase):
+   targets = moves
+   updates = 0
+   def after_advice(self, retval, *args, **kwargs):
+      Observer.updates += 1
+
+class Trace(DepthBase):
+   targets = moves
+   calls = 0
+   deepest = 0
+   def before_advice(self, *args, **kwargs):
+      Trace.calls += 1
+      Trace.deepest = max(Trace.deepest, self.depth)
+
+class Callers(CallBase):
+   targets = moves
+   callers = set()
+   def before_advice(self, *args, **kwargs):
+      Callers.callers.add(self.caller)
+
+class Tracing(TraceBase):
+   targets = moves
+
+def make_canvas():
+   return sample_classes.Canvas(
+      [sample_classes.Polygon([sample_classes.Line(sample_classes.Point(0, 0),
+                                                   sample_classes.Point(i, j))
+                               for j in range(LINES)])
+       for i in range(POLYGONS)])
+
+def run():
+   canvas = make_canvas()
+   directory = tempfile.mkdtemp()
+   Tracing.recorder = tracing.TraceRecorder(os.path.join(directory,
+                                                         "trace.bin"))
+   configurations = [("unwoven", ()),
+                     ("observer", (Observer,)),
+                     ("trace", (Trace,)),
+                     ("callers", (Callers,)),
+                     ("tracing", (Tracing,)),
+                     ("all three", (Observer, Trace, Callers))]
+   results = []
+   for label, aspects in configurations:
+      enable_all(*aspects)
+      results.append((label, per_call(lambda: canvas.move_by(1, 1),
+                                      number=200, repeat=3)))
+      weaver.reset_all()
+   Tracing.recorder.close()
+   shutil.rmtree(directory)
+   return results
+
+if __name__ == "__main__":
+   report(__doc__.strip().splitlines()[0], run(), unit="move")
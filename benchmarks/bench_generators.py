@@ -0,0 +1,50 @@
+'''
+Per-item cost of GeneratorBase compared with delegating through yield from.
+'''
+from __future__ import print_function
+from common import per_call, report
+from AOPy import GeneratorBase
+
+ITEMS = 10000
+
+def produce(n):
+   for i in range(n):
+      yield i
+
+try:
+   exec("def delegate(n):\n   yield from produce(n)\n")
+except SyntaxError:
+   # No yield from before Python 3.3; the closest equivalent is a loop
+   def delegate(n):
+      for item in produce(n):
+         yield item
+
+class NoHooks(GeneratorBase):
+   targets = []
+
+class ItemHook(GeneratorBase):
+   targets = []
+   def on_item(self, item, *args, **kwargs):
+      pass
+
+class AllHooks(ItemHook):
+   targets = []
+   def on_exhaust(self, retval, *args, **kwargs):
+      pass
+   def on_close(self, *args, **kwargs):
+      pass
+
+def consume(generator_function):
+   for _ in generator_function(ITEMS):
+      pass
+
+def run():
+   results = [("bare generator", produce), ("yield from", delegate)]
+   for aspect_class in (NoHooks, ItemHook, AllHooks):
+      results.append((aspect_class.__name__,
+                      aspect_class(produce, produce)))
+   return [(label, per_call(lambda: consume(function), number=20) / ITEMS)
+           for label, function in results]
+
+if __name__ == "__main__":
+   report(__doc__.strip().splitlines()[0], run(), unit="item")
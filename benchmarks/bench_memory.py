@@ -0,0 +1,77 @@
+'''
+How much memory weaving takes per target, and whether it all comes back.
+
+An aspect is enabled on every method of a generated module, once as an
+ordinary subclass (with a __dict__ per instance), once with __slots__ = ()
+and once with stateless = True as well, so that all the targets share an
+instance. Memory is measured with tracemalloc, so this needs Python 3.4 or
+later. "retained" is what weaving left allocated, per target, once the
+aspects are disabled and the module is dropped again.
+'''
+from __future__ import print_function
+import gc
+import sys
+from AOPy import ExecutionBase
+from AOPy import weaver
+from bench_registry import make_module, module_targets
+
+try:
+   import tracemalloc
+except ImportError:
+   tracemalloc = None
+
+TARGETS = 50000
+
+class Default(ExecutionBase):
+   def before_advice(self, *args, **kwargs):
+      pass
+
+class Slotted(ExecutionBase):
+   __slots__ = ()
+
+   def before_advice(self, *args, **kwargs):
+      pass
+
+class Stateless(ExecutionBase):
+   __slots__ = ()
+   stateless = True
+
+   def before_advice(self, *args, **kwargs):
+      pass
+
+def traced():
+   gc.collect()
+   return tracemalloc.get_traced_memory()[0]
+
+def run():
+   if tracemalloc is None:
+      return []
+   results = []
+   retained = 0
+   for Aspect in (Default, Slotted, Stateless):
+      module = make_module("bench_memory", TARGETS)
+      Aspect.targets = module_targets(module)
+      # Only weaving is traced, so the module itself isn't counted
+      tracemalloc.start()
+      try:
+         before = traced()
+         Aspect.enable()
+         results.append((Aspect.__name__.lower(),
+                         float(traced() - before) / TARGETS))
+         Aspect.disable()
+         Aspect.targets = []
+         del sys.modules["bench_memory"], module
+         weaver.registry.tidy()
+         retained += traced() - before
+      finally:
+         tracemalloc.stop()
+   results.append(("retained", float(retained) / (3 * TARGETS)))
+   return results
+
+if __name__ == "__main__":
+   print(__doc__.strip().splitlines()[0])
+   if tracemalloc is None:
+      print("  (needs tracemalloc)")
+   print("  (%d targets)" % TARGETS)
+   for label, size in run():
+      print("  %-10s %8.1f bytes/target" % (label, size))
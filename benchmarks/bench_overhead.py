@@ -0,0 +1,149 @@
+'''
+Per-call overhead of each aspect base class against an unwoven baseline.
+
+Every target is woven through the weaver, exactly as enable() would do it, and
+every aspect overrides before_advice (with a no-op, except for CoverageBase,
+which has one of its own) so that compiled chains can't leave it out.
+Measured for each base class:
+
+   xN: a leaf function with N aspects of that base stacked on it, in both
+       chain modes
+   recursion: a function that recurses RECURSION levels, woven at every level
+   deep stack: a chain of DEPTH distinct woven functions calling each other
+
+ExecutionBase is also measured under the code backend, called through a
+reference to the leaf function taken before weaving, and on writes and reads
+of an attribute (see AOPy.fields), next to an attribute of the same object
+that isn't woven.
+The recursion and deep stack figures are per level, to be compared with the
+unwoven figure for a single call.
+'''
+from __future__ import print_function
+import sys
+import types
+from common import per_call, report
+from AOPy import (ExecutionBase, CallBase, JoinPointBase, DepthBase, CFlowBase,
+                  CoverageBase, SamplingBase, weaver)
+from AOPy import fields
+
+BASES = (ExecutionBase, CallBase, JoinPointBase, DepthBase, CFlowBase,
+         CoverageBase)
+STACKS = (1, 2, 4, 8)
+RECURSION = 50
+DEPTH = 50
+
+# The targets live in a module of their own so that they can be woven
+module = types.ModuleType("bench_overhead_targets")
+exec(compile("\n".join(
+   ["def leaf(x):\n   return x",
+    "def recurse(n):\n   return n if n == 0 else recurse(n - 1)"] +
+   ["def f%d(x):\n   return f%d(x)" % (i, i + 1) for i in range(DEPTH - 1)] +
+   ["def f%d(x):\n   return x" % (DEPTH - 1)] +
+   ["class Point(object):\n   def __init__(self):\n      self.x = self.y = 0",
+    "class SlotPoint(object):\n   __slots__ = ('x', 'y')\n"
+    "   def __init__(self):\n      self.x = self.y = 0"]),
+   module.__name__, "exec"), module.__dict__)
+sys.modules[module.__name__] = module
+
+def make_aspect(base, targets):
+   namespace = {"targets": targets}
+   if base is not CoverageBase:
+      # CoverageBase's own before_advice is what is being measured
+      namespace["before_advice"] = lambda self, *args, **kwargs: None
+   return type(base.__name__ + "Aspect", (base,), namespace)
+
+def enable(aspects):
+   for aspect in aspects:
+      aspect.enable()
+
+def run():
+   results = [("unwoven", per_call(lambda: module.leaf(1), number=20000,
+                                   repeat=3)),
+              ("unwoven recursion", per_call(lambda: module.recurse(RECURSION),
+                                             number=2000, repeat=3)
+               / (RECURSION + 1)),
+              ("unwoven deep stack", per_call(lambda: module.f0(1),
+                                              number=2000, repeat=3) / DEPTH)]
+   for base in BASES:
+      for mode in ("layered", "compiled"):
+         weaver.set_chain_mode(mode)
+         for count in STACKS:
+            enable([make_aspect(base, [module.leaf]) for _ in range(count)])
+            results.append(("%s x%d (%s)" % (base.__name__, count, mode),
+                            per_call(lambda: module.leaf(1), number=20000,
+                                     repeat=3)))
+            weaver.reset_all()
+      weaver.set_chain_mode("layered")
+      enable([make_aspect(base, [module.recurse])])
+      results.append(("%s recursion" % base.__name__,
+                      per_call(lambda: module.recurse(RECURSION), number=2000,
+                               repeat=3) / (RECURSION + 1)))
+      weaver.reset_all()
+      enable([make_aspect(base, [getattr(module, "f%d" % i)
+                                 for i in range(DEPTH)])])
+      results.append(("%s deep stack" % base.__name__,
+                      per_call(lambda: module.f0(1), number=2000, repeat=3)
+                      / DEPTH))
+      weaver.reset_all()
+   # A sampling aspect that (almost) never samples only counts calls
+   aspect = make_aspect(SamplingBase, [module.leaf])
+   aspect.sample_every = 10 ** 9
+   enable([aspect])
+   results.append(("SamplingBase not sampled",
+                   per_call(lambda: module.leaf(1), number=20000, repeat=3)))
+   weaver.reset_all()
+   # Once hit, a self-unweaving coverage aspect should cost nothing at all
+   aspect = make_aspect(CoverageBase, [module.leaf])
+   aspect.unweave_on_hit = True
+   enable([aspect])
+   module.leaf(1)
+   CoverageBase.unweave_hits()
+   results.append(("CoverageBase unweave_on_hit",
+                   per_call(lambda: module.leaf(1), number=20000, repeat=3)))
+   weaver.reset_all()
+   leaf = module.leaf
+   weaver.set_backend("code")
+   for mode in ("layered", "compiled"):
+      weaver.set_chain_mode(mode)
+      for count in (1, 4):
+         enable([make_aspect(ExecutionBase, [module.leaf])
+                 for _ in range(count)])
+         name = "ExecutionBase x%d (%s, code backend)" % (count, mode)
+         results.append((name, per_call(lambda: leaf(1), number=20000,
+                                        repeat=3)))
+         weaver.reset_all()
+   weaver.set_chain_mode("layered")
+   weaver.set_backend("attribute")
+   results.extend(field_results(module.Point()))
+   results.extend(field_results(module.SlotPoint(), "slot"))
+   return results
+
+def field_results(point, kind="attribute"):
+   def write_x():
+      point.x = 1
+   def write_y():
+      point.y = 1
+   def read_x():
+      return point.x
+   results = [("unwoven %s write" % kind,
+               per_call(write_x, number=20000, repeat=3)),
+              ("unwoven %s read" % kind,
+               per_call(read_x, number=20000, repeat=3))]
+   for mode in ("layered", "compiled"):
+      weaver.set_chain_mode(mode)
+      enable([make_aspect(ExecutionBase, fields.writes(type(point), "x"))])
+      results.append(("ExecutionBase %s write (%s)" % (kind, mode),
+                      per_call(write_x, number=20000, repeat=3)))
+      if mode == "layered":
+         results.append(("%s write beside a woven one" % kind,
+                         per_call(write_y, number=20000, repeat=3)))
+      weaver.reset_all()
+      enable([make_aspect(ExecutionBase, fields.reads(type(point), "x"))])
+      results.append(("ExecutionBase %s read (%s)" % (kind, mode),
+                      per_call(read_x, number=20000, repeat=3)))
+      weaver.reset_all()
+   weaver.set_chain_mode("layered")
+   return results
+
+if __name__ == "__main__":
+   report(__doc__.strip().splitlines()[0], run())
@@ -0,0 +1,67 @@
+'''
+How enabling and disabling an aspect scales with the number of targets.
+
+Targets are methods on generated classes in a generated module. For
+comparison, the key lookup the weaver used to do (inspect.getmodule) is timed
+over the same targets. Timings are per target.
+'''
+from __future__ import print_function
+import sys
+import time
+import types
+import inspect
+from AOPy import ExecutionBase
+from AOPy import weaver
+from common import report
+
+METHODS_PER_CLASS = 10
+SIZES = (1000, 5000, 20000)
+
+def make_module(name, targets):
+   '''
+   Create and register a module with enough classes to hold targets methods.
+   '''
+   module = types.ModuleType(name)
+   lines = []
+   for i in range(targets // METHODS_PER_CLASS):
+      lines.append("class C%d(object):" % i)
+      for j in range(METHODS_PER_CLASS):
+         lines.append("   def m%d(self):\n      return %d" % (j, j))
+   exec(compile("\n".join(lines), name, "exec"), module.__dict__)
+   sys.modules[name] = module
+   return module
+
+def module_targets(module):
+   return [getattr(class_, name)
+           for class_ in vars(module).values() if isinstance(class_, type)
+           for name in vars(class_) if name.startswith("m")]
+
+def old_get_key(obj):
+   return (inspect.getmodule(obj), getattr(obj, "im_class", None),
+           obj.__name__)
+
+def seconds(func):
+   start = time.time()
+   func()
+   return time.time() - start
+
+def run():
+   results = []
+   for size in SIZES:
+      module = make_module("bench_registry_%d" % size, size)
+      class Aspect(ExecutionBase):
+         targets = module_targets(module)
+      for label, func in (
+            ("old keys", lambda: [old_get_key(target)
+                                  for target in Aspect.targets]),
+            ("keys", lambda: [weaver.get_key(target)
+                              for target in Aspect.targets]),
+            ("enable", Aspect.enable),
+            ("disable", Aspect.disable)):
+         results.append(("%s x%d" % (label, size), seconds(func) / size * 1e9))
+      weaver.reset_all()
+      del sys.modules[module.__name__]
+   return results
+
+if __name__ == "__main__":
+   report(__doc__.strip().splitlines()[0], run(), unit="target")
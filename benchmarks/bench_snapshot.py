@@ -0,0 +1,52 @@
+'''
+How long undoing one test's weaving takes, with a lot woven already.
+
+A background aspect is enabled on every target, as a test suite's fixtures
+might do, and each "test" enables a small aspect on a handful of targets.
+Afterwards the weaving is undone with weaver.restore, and for comparison by
+disabling the small aspect, and by resetting everything and enabling the
+background aspect again, which is what reset_all leaves a suite to do.
+'''
+from __future__ import print_function
+from AOPy import ExecutionBase
+from AOPy import weaver
+from bench_registry import make_module, module_targets, seconds
+
+TARGETS = 20000
+TEST_TARGETS = 10
+TESTS = 100
+
+def run():
+   module = make_module("bench_snapshot", TARGETS)
+   targets = module_targets(module)
+   class Background(ExecutionBase):
+      pass
+   Background.targets = targets
+   class Test(ExecutionBase):
+      pass
+   Test.targets = targets[:TEST_TARGETS]
+   Background.enable()
+   def restore():
+      for _ in range(TESTS):
+         with weaver.isolated():
+            Test.enable()
+   def disable():
+      for _ in range(TESTS):
+         Test.enable()
+         Test.disable()
+   def reset():
+      for _ in range(TESTS // 10):
+         Test.enable()
+         weaver.reset_all()
+         Background.enable()
+   results = [("restore", seconds(restore) / TESTS * 1e9),
+              ("disable", seconds(disable) / TESTS * 1e9),
+              ("reset_all", seconds(reset) / (TESTS // 10) * 1e9)]
+   weaver.reset_all()
+   return results
+
+if __name__ == "__main__":
+   print(__doc__.strip().splitlines()[0])
+   print("  (%d targets woven, %d more per test)" % (TARGETS, TEST_TARGETS))
+   for label, ns in run():
+      print("  %-10s %10.3f ms/test" % (label, ns / 1e6))
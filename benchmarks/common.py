@@ -0,0 +1,22 @@
+'''
+Helpers shared by the benchmark scripts in this directory. Run them from the
+repository root with AOPy importable, e.g.
+"python benchmarks/bench_context.py".
+'''
+from __future__ import print_function
+import timeit
+
+def per_call(func, number=100000, repeat=5):
+   '''
+   Best-of-repeat time for a single call of func, in nanoseconds.
+   '''
+   return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e9
+
+def report(title, results, unit="call"):
+   '''
+   Print a table of (label, nanoseconds) pairs.
+   '''
+   print(title)
+   width = max(len(label) for label, _ in results)
+   for label, ns in results:
+      print("  %-*s %10.1f ns/%s" % (width, label, ns, unit))
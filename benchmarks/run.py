@@ -0,0 +1,89 @@
+'''
+Run every benchmark in this directory and write the results as JSON, so that
+runs on different versions can be compared:
+
+   python benchmarks/run.py --output results.json
+   python benchmarks/run.py --compare results.json
+
+--compare prints each timing that got slower by more than --threshold (a
+ratio, 1.1 by default) since the given run, and exits with status 1 if there
+were any. Timings are in nanoseconds per unit, except for bench_memory,
+whose results are in bytes.
+'''
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+import platform
+import importlib
+
+# Each benchmark module has a run() function returning (label, timing) pairs;
+# the unit is what its timings are per
+BENCHMARKS = (("bench_overhead", "call"),
+              ("bench_figure_editor", "move"),
+              ("bench_context", "call"),
+              ("bench_generators", "item"),
+              ("bench_registry", "target"),
+              ("bench_snapshot", "test"),
+              ("bench_memory", "target"))
+
+def run(names=None):
+   benchmarks = {}
+   for name, unit in BENCHMARKS:
+      if names and name not in names:
+         continue
+      print("running %s" % name, file=sys.stderr)
+      results = dict(importlib.import_module(name).run())
+      benchmarks[name] = {"unit": unit, "results": results}
+   return {"python": platform.python_version(),
+           "implementation": platform.python_implementation(),
+           "machine": platform.machine(),
+           "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "benchmarks": benchmarks}
+
+def compare(old, new, threshold):
+   '''
+   List (benchmark, label, old, new) for each timing in both runs that got
+   slower by more than threshold.
+   '''
+   regressions = []
+   for name, benchmark in sorted(new["benchmarks"].items()):
+      old_benchmark = old["benchmarks"].get(name)
+      if old_benchmark is None:
+         continue
+      for label, ns in sorted(benchmark["results"].items()):
+         old_ns = old_benchmark["results"].get(label)
+         if old_ns and ns / old_ns > threshold:
+            regressions.append((name, label, old_ns, ns))
+   return regressions
+
+def main(argv=None):
+   description = __doc__.strip().splitlines()[0]
+   parser = argparse.ArgumentParser(description=description)
+   parser.add_argument("--output", help="write the results to this file "
+                       "instead of standard output")
+   parser.add_argument("--compare", help="results of an earlier run to check "
+                       "for regressions against")
+   parser.add_argument("--threshold", type=float, default=1.1)
+   parser.add_argument("benchmarks", nargs="*",
+                       help="only run these (e.g. bench_overhead)")
+   args = parser.parse_args(argv)
+   results = run(args.benchmarks)
+   text = json.dumps(results, indent=1, sort_keys=True)
+   if args.output:
+      with open(args.output, "w") as output:
+         output.write(text + "\n")
+   elif not args.compare:
+      print(text)
+   if args.compare:
+      with open(args.compare) as baseline:
+         regressions = compare(json.load(baseline), results, args.threshold)
+      for name, label, old_ns, ns in regressions:
+         print("%s: %s went from %.1f to %.1f (x%.2f)"
+               % (name, label, old_ns, ns, ns / old_ns))
+      return 1 if regressions else 0
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main())
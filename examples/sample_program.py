@@ -7,7 +7,10 @@ When using an observer aspect derived from ExecutionBase, we erroneously trigger
 multiple screen redraws before the entire data model has been updated. Simply by
 deriving from CFlowBase instead, we ensure that the redraw does not occur until
 the topmost invocation of move_by returns. Go into sample_aspects.py and change
-production_aspects to see this.
+production_aspects to see this. Even then, separate moves redraw once each, so
+for the moves made in one "tick" at the end we swap in CoalescingObserverAspect
+instead, and they share a single redraw.
+
 
 With this project structure, we can seamlessly introduce aspects for debugging
 as well. Run this file as "python sample_program.py -d" to see.
@@ -17,7 +20,9 @@ from __future__ import print_function
 from sample_classes import Canvas, Polygon, Line, Point
 #from sample_classes_tangled import Canvas, Polygon, Line, Point
 #from sample_classes_decorator import Canvas, Polygon, Line, Point
-from sample_aspects import active_debug_aspects, production_aspects
+from sample_aspects import (active_debug_aspects, production_aspects,
+                            CoalescingObserverAspect)
+from AOPy import enable_all, disable_all
 
 import argparse
 parser = argparse.ArgumentParser(description="Test some aspects!")
@@ -27,12 +32,10 @@ parser.add_argument("-d", dest="debug", action="store_const",
 args = parser.parse_args()
 
 
-for aspect in production_aspects:
-   aspect.enable()
+enable_all(*production_aspects)
 
 if args.debug:
-   for aspect in active_debug_aspects:
-      aspect.enable()
+   enable_all(*active_debug_aspects)
 
 
 square = Polygon([Line(Point(1,1), Point(1,4)),
@@ -55,5 +58,14 @@ print("About to move a shape containing lines containing points.")
 square.move_by(4,5)
 print("")
 
-print("About to move a canvas containing shapes containing lines containing points.")
+print("About to move a canvas containing shapes containing lines containing "
+      "points.")
 canvas.move_by(6,7)
+print("")
+
+print("About to move everything on the canvas in one tick.")
+disable_all(*production_aspects)
+enable_all(CoalescingObserverAspect)
+with CoalescingObserverAspect.coalescing():
+   for shape in (square, line, point):
+      shape.move_by(1,1)